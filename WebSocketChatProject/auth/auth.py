@@ -1,9 +1,10 @@
+import logging
 import os
 import secrets
 from datetime import datetime, timedelta
 
+import httpx
 import jwt
-import requests
 
 from .schemas import UserInfo, User, UserInDB, UserLogin, UserRead, ForgetPasswordRequest
 from database import get_async_session
@@ -20,11 +21,14 @@ from starlette.responses import JSONResponse
 from fastapi_mail import FastMail, MessageSchema, MessageType, ConnectionConfig
 
 from models.models import UserData
-from .utils import verify_token, generate_token, create_reset_password_token
+from .google import GoogleOAuthClient
+from .passwords import PasswordHasher
+from .utils import verify_token, generate_token, create_reset_password_token, verifier
 from config import EnvObjectsForEmail, Settings
 
 load_dotenv()
 register_router = APIRouter()
+logger = logging.getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
 
@@ -51,6 +55,21 @@ mail_config = ConnectionConfig(
 settings_email = EnvObjectsForEmail()
 settings = Settings()
 
+password_hasher = PasswordHasher(
+    pwd_context,
+    workers=settings.PASSWORD_HASH_WORKERS,
+    concurrency=settings.PASSWORD_HASH_CONCURRENCY,
+    max_pending=settings.PASSWORD_HASH_MAX_PENDING,
+)
+google_client = GoogleOAuthClient(
+    GOOGLE_CLIENT_ID,
+    GOOGLE_SECRET_KEY,
+    GOOGLE_REDIRECT_URL,
+    discovery_url=settings.GOOGLE_DISCOVERY_URL,
+    timeout=settings.GOOGLE_HTTP_TIMEOUT,
+    retries=settings.GOOGLE_HTTP_RETRIES,
+)
+
 
 @register_router.get("/login/google")
 async def login_google():
@@ -61,24 +80,24 @@ async def login_google():
 
 @register_router.get("/auth/google")
 async def auth_google(code: str, session: AsyncSession = Depends(get_async_session)):
-    token_url = "https://accounts.google.com/o/oauth2/token"
-    data = {
-        "code": code,
-        "client_id": GOOGLE_CLIENT_ID,
-        "client_secret": GOOGLE_SECRET_KEY,
-        "redirect_uri": GOOGLE_REDIRECT_URL,
-        "grant_type": "authorization_code",
-    }
-    response = requests.post(token_url, data=data)
-    access_token = response.json().get("access_token")
-    user_info = requests.get("https://www.googleapis.com/oauth2/v1/userinfo",
-                             headers={"Authorization": f"Bearer {access_token}"})
-    user_info_data = user_info.json()
+    try:
+        token_data = await google_client.exchange_code(code)
+        # the profile scope puts the names in the id_token; userinfo only
+        # for accounts that lack them
+        user_info_data = await google_client.verify_id_token(token_data['id_token'])
+        if not {'given_name', 'family_name'} <= user_info_data.keys():
+            user_info_data = {**user_info_data, **await google_client.userinfo(token_data['access_token'])}
+    except (httpx.HTTPError, KeyError):
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail='Google sign-in failed')
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid Google ID token')
+    if not user_info_data.get('email_verified'):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Google email is not verified')
     user_data = {
         'first_name': user_info_data['given_name'],
         'last_name': user_info_data['family_name'],
         'username': user_info_data['email'],
-        'password': pwd_context.hash(user_info_data['email'])
+        'password': await password_hasher.hash(user_info_data['email'])
     }
     query_exist = select(UserData).where(UserData.username == user_info_data['email'])
     user_exist_data = await session.execute(query_exist)
@@ -105,7 +124,7 @@ async def register(user: User, session: AsyncSession = Depends(get_async_session
     if user.password1 == user.password2:
         if not select(UserData).where(UserData.username == user.username).exists:
             return {'success': False, 'message': 'Username already exists!'}
-        password = pwd_context.hash(user.password1)
+        password = await password_hasher.hash(user.password1)
         user_in_db = UserInDB(**dict(user), password=password, joined_at=datetime.utcnow())
         query = insert(UserData).values(**dict(user_in_db))
         await session.execute(query)
@@ -119,8 +138,8 @@ async def login(user: UserLogin, session: AsyncSession = Depends(get_async_sessi
     query = select(UserData).where(UserData.username == user.username)
     userdata = await session.execute(query)
     user_data = userdata.one()
-    print(user_data[0].id)
-    if pwd_context.verify(user.password, user_data[0].password):
+    logger.debug('Login attempt for user %s', user_data[0].id)
+    if await password_hasher.verify(user.password, user_data[0].password):
         token = generate_token(user_data[0].id)
         return token
     else:
@@ -148,16 +167,16 @@ async def refresh_auth_token(
         refresh_token: str
 ):
     try:
-        secret_key = os.environ.get('SECRET')
-        payload = jwt.decode(refresh_token, secret_key, algorithms=['HS256'])
+        payload = verifier.decode(refresh_token)
         jti_access = str(secrets.token_urlsafe(32))
         data_access_token = {
             'token_type': 'access',
             'exp': datetime.utcnow() + timedelta(minutes=30),
             'user_id': payload.get('user_id'),
-            'jti': jti_access
+            'jti': jti_access,
+            'refresh_jti': payload.get('jti')
         }
-        access_token = jwt.encode(data_access_token, secret_key, 'HS256')
+        access_token = verifier.encode(data_access_token)
         return {
             'access_token': access_token
         }
@@ -167,6 +186,16 @@ async def refresh_auth_token(
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+@register_router.post('/logout')
+async def logout(token: dict = Depends(verify_token)):
+    if token.get('jti') is not None:
+        await verifier.revoke(token['jti'], token.get('exp'))
+    if token.get('refresh_jti') is not None:
+        # its exp isn't in the access token; revoked for a full refresh lifetime
+        await verifier.revoke(token['refresh_jti'])
+    return {'success': True}
+
+
 @register_router.post("/forget-password")
 async def forget_password(
         background_tasks: BackgroundTasks,
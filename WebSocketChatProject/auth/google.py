@@ -0,0 +1,153 @@
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+import jwt
+
+DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# errors raised before the request reached the server
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+ID_TOKEN_ALGORITHMS = ['RS256']
+# Google signs ID tokens with either form of its issuer
+GOOGLE_ISSUERS = {'https://accounts.google.com', 'accounts.google.com'}
+
+
+class GoogleOAuthClient:
+    """Google sign-in over one pooled, keep-alive ``httpx.AsyncClient``.
+
+    Endpoints come from the OpenID discovery document, which is cached
+    together with the JWKS for ``cache_ttl`` seconds; the keys verify the
+    id_token of the code exchange, so the profile needs no further call.
+    Pointing ``discovery_url`` at a local server (or passing an
+    ``httpx.MockTransport``) is enough to run the flow without Google.
+
+    Retries happen in ``_request`` only. GETs are retried on timeouts,
+    network errors and 5xx/429 answers; the code exchange is retried only
+    when the connection failed, since an authorization code is good for a
+    single use and a POST that reached Google may have spent it.
+    """
+
+    def __init__(
+            self,
+            client_id: Optional[str],
+            client_secret: Optional[str],
+            redirect_url: Optional[str],
+            discovery_url: str = DISCOVERY_URL,
+            timeout: float = 10.0,
+            retries: int = 2,
+            cache_ttl: float = 3600,
+            transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_url = redirect_url
+        self.discovery_url = discovery_url
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_ttl = cache_ttl
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache = {}
+        self._locks = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, url: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+        retry_on = (httpx.TimeoutException, httpx.NetworkError) if idempotent else CONNECT_ERRORS
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except retry_on:
+                if attempt == self.retries:
+                    raise
+            else:
+                if not idempotent or response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+            await asyncio.sleep(0.2 * 2 ** attempt)
+
+    async def _cached(self, name: str, url_getter) -> dict:
+        entry = self._cache.get(name)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        async with lock:
+            entry = self._cache.get(name)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            response = await self._request('GET', await url_getter())
+            data = response.json()
+            self._cache[name] = (time.monotonic() + self.cache_ttl, data)
+            return data
+
+    async def discovery(self) -> dict:
+        async def url():
+            return self.discovery_url
+        return await self._cached('discovery', url)
+
+    async def jwks(self) -> dict:
+        async def url():
+            return (await self.discovery())['jwks_uri']
+        return await self._cached('jwks', url)
+
+    async def exchange_code(self, code: str) -> dict:
+        endpoints = await self.discovery()
+        response = await self._request('POST', endpoints['token_endpoint'], idempotent=False, data={
+            'code': code,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': self.redirect_url,
+            'grant_type': 'authorization_code',
+        })
+        return response.json()
+
+    async def verify_id_token(self, id_token: str) -> dict:
+        """Claims of ``id_token`` once its signature, audience, issuer and expiry check out.
+
+        Raises ``jwt.InvalidTokenError`` otherwise. A key id missing from the
+        cached JWKS refetches it once, Google rotates its keys.
+        """
+        kid = jwt.get_unverified_header(id_token).get('kid')
+        for refresh in (False, True):
+            if refresh:
+                self._cache.pop('jwks', None)
+            keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(await self.jwks()).keys}
+            if kid in keys:
+                break
+        else:
+            raise jwt.InvalidTokenError(f'Unknown signing key: {kid}')
+        claims = jwt.decode(
+            id_token,
+            keys[kid].key,
+            algorithms=ID_TOKEN_ALGORITHMS,
+            audience=self.client_id,
+            options={'require': ['iss', 'exp', 'aud']},
+        )
+        # checked here: this PyJWT compares ``iss`` with a single value only
+        if claims['iss'] not in GOOGLE_ISSUERS | {(await self.discovery())['issuer']}:
+            raise jwt.InvalidIssuerError('Invalid issuer')
+        return claims
+
+    async def userinfo(self, access_token: str) -> dict:
+        endpoints = await self.discovery()
+        response = await self._request(
+            'GET', endpoints['userinfo_endpoint'], headers={'Authorization': f'Bearer {access_token}'}
+        )
+        return response.json()
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from metrics import BCRYPT_SECONDS
+
+HASH_SECONDS = BCRYPT_SECONDS.labels('hash')
+VERIFY_SECONDS = BCRYPT_SECONDS.labels('verify')
+
+
+class PasswordHasher:
+    """Runs bcrypt off the event loop.
+
+    bcrypt releases the GIL, so a small thread pool is enough to keep
+    sockets and other requests moving while passwords are hashed. At most
+    ``concurrency`` hashes run at once and at most ``max_pending`` callers
+    wait for a slot; anything beyond that is rejected with 503 right away
+    instead of piling up behind a login storm.
+    """
+
+    def __init__(self, context: CryptContext, workers: int = 4, concurrency: Optional[int] = None, max_pending: int = 64):
+        self.context = context
+        self.concurrency = concurrency or workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.waiting = 0
+        self.rejected = 0
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _run(self, histogram, func, *args):
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Too many login attempts, try again later',
+                headers={'Retry-After': '1'},
+            )
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            started = time.perf_counter()
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self._slots.release()
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed)
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(HASH_SECONDS, self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(VERIFY_SECONDS, self.context.verify, password, hashed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'count': self.count,
+            'avg_time': self.total_time / self.count if self.count else 0.0,
+            'max_time': self.max_time,
+        }
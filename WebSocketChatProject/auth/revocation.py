@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryRevocations:
+    """Revoked ``jti`` values of this process, each kept until its token expires.
+
+    Expiry times also go on a heap, so entries leave in expiry order as new
+    ones come in instead of the whole set being rebuilt.
+    """
+
+    def __init__(self):
+        self.until: Dict[str, float] = {}
+        self._expiry: List[Tuple[float, str]] = []
+
+    def __contains__(self, jti: str) -> bool:
+        until = self.until.get(jti)
+        return until is not None and until > time.time()
+
+    def __len__(self) -> int:
+        return len(self.until)
+
+    def add(self, jti: str, until: float):
+        if until <= self.until.get(jti, 0):
+            return
+        self.until[jti] = until
+        heapq.heappush(self._expiry, (until, jti))
+        self.expire()
+
+    def expire(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            until, jti = heapq.heappop(expiry)
+            # a later revocation of the same jti has its own heap entry
+            if self.until.get(jti) == until:
+                del self.until[jti]
+
+    async def revoke(self, jti: str, until: float):
+        self.add(jti, until)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'revoked': len(self.until)}
+
+
+class RedisRevocations(MemoryRevocations):
+    """Revocations shared by every worker.
+
+    Each jti is a key expiring with its token and is announced on a
+    channel, from which every worker adds it to its local set; checking a
+    token stays a dict lookup. The keys already in Redis are loaded on
+    every (re)subscribe, so a worker that was cut off catches up. When
+    Redis is unreachable a revocation still holds in the worker that made
+    it.
+    """
+
+    def __init__(
+            self,
+            url: Optional[str] = None,
+            client=None,
+            prefix: str = 'chat:revoked:',
+            channel: str = 'chat:revocations'
+    ):
+        super().__init__()
+        if client is None:
+            try:
+                from redis import asyncio as aioredis
+            except ImportError:
+                raise RuntimeError('RedisRevocations requires the "redis" package')
+            client = aioredis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.channel = channel
+        self.errors = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def revoke(self, jti: str, until: float):
+        self.add(jti, until)
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.set(self.prefix + jti, repr(until), ex=max(1, math.ceil(until - time.time())))
+            pipeline.publish(self.channel, f'{jti} {until!r}')
+            await pipeline.execute()
+        except Exception:
+            self.errors += 1
+            logger.exception('Could not share a token revocation, it holds for this worker only')
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.client.close()
+
+    async def _listen(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                await self._load()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        jti, until = message['data'].decode().rsplit(' ', 1)
+                        self.add(jti, float(until))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception('Token revocation listener failed')
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+    async def _load(self):
+        keys = [key async for key in self.client.scan_iter(match=self.prefix + '*', count=1000)]
+        if not keys:
+            return
+        for key, until in zip(keys, await self.client.mget(keys)):
+            # gone between the scan and the read: expired
+            if until is not None:
+                self.add(key.decode()[len(self.prefix):], float(until))
+
+    def stats(self) -> dict:
+        return {'revoked': len(self.until), 'errors': self.errors}
+
+
+def make_revocations(url: Optional[str]) -> MemoryRevocations:
+    if not url or url.startswith('memory://'):
+        return MemoryRevocations()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRevocations(url)
+    raise ValueError(f'Unsupported token revocation store url: {url}')
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 from sqlalchemy import TIMESTAMP
@@ -45,5 +46,10 @@ class UserRead(BaseModel):
     # joined_at: datetime
 
 
+class UserPageScheme(BaseModel):
+    items: List[UserRead]
+    next_cursor: Optional[int] = None
+
+
 class ForgetPasswordRequest(BaseModel):
     email: str
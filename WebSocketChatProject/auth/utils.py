@@ -1,15 +1,104 @@
+import hashlib
 import os
 import jwt
 import secrets
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Optional
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, OAuth2PasswordBearer
 from fastapi import Depends, HTTPException
 from dotenv import load_dotenv
 
+from config import Settings
+from metrics import JWT_DECODES
+from .revocation import MemoryRevocations, make_revocations
+
 load_dotenv()
 secret_key = os.environ.get('SECRET')
 algorithm = 'HS256'
 security = HTTPBearer()
+settings = Settings()
+
+DECODED_CACHED = JWT_DECODES.labels('cached')
+DECODED_VERIFIED = JWT_DECODES.labels('verified')
+DECODE_REJECTED = JWT_DECODES.labels('rejected')
+REFRESH_TOKEN_LIFETIME = timedelta(days=1)
+
+
+class TokenVerifier:
+    """Signs and verifies JWTs with one key loaded at startup.
+
+    Decoded payloads are cached by token digest until their ``exp``, so a
+    client polling with the same token costs a hash and a dict lookup
+    instead of a signature check. Revoked ``jti`` values are kept in
+    ``revoked`` until the token would have expired anyway; with a Redis
+    store every worker rejects them.
+    """
+
+    def __init__(
+            self,
+            key: str,
+            algorithm: str = 'HS256',
+            max_entries: int = 10000,
+            revoked: Optional[MemoryRevocations] = None
+    ):
+        self.key = key
+        self.algorithm = algorithm
+        self.algorithms = [algorithm]
+        self.max_entries = max_entries
+        self.cache: 'OrderedDict[bytes, dict]' = OrderedDict()
+        self.revoked = revoked if revoked is not None else MemoryRevocations()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, payload: dict) -> str:
+        return jwt.encode(payload, self.key, self.algorithm)
+
+    def decode(self, token: str) -> dict:
+        digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        payload = self.cache.get(digest)
+        if payload is None:
+            self.misses += 1
+            try:
+                payload = jwt.decode(token, self.key, algorithms=self.algorithms)
+            except jwt.InvalidTokenError:
+                DECODE_REJECTED.inc()
+                raise
+            DECODED_VERIFIED.inc()
+            if 'exp' in payload:
+                self.cache[digest] = payload
+                if len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+        else:
+            if payload['exp'] <= time.time():
+                del self.cache[digest]
+                DECODE_REJECTED.inc()
+                raise jwt.ExpiredSignatureError('Signature has expired')
+            self.cache.move_to_end(digest)
+            self.hits += 1
+            DECODED_CACHED.inc()
+        jti = payload.get('jti')
+        if jti is not None and jti in self.revoked:
+            DECODE_REJECTED.inc()
+            raise jwt.InvalidTokenError('Token has been revoked')
+        return payload
+
+    async def revoke(self, jti: str, exp: Optional[float] = None):
+        await self.revoked.revoke(jti, exp if exp is not None else time.time() + REFRESH_TOKEN_LIFETIME.total_seconds())
+
+    def stats(self) -> dict:
+        return {
+            'cached': len(self.cache),
+            **self.revoked.stats(),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+verifier = TokenVerifier(
+    secret_key, algorithm, settings.TOKEN_CACHE_SIZE, make_revocations(settings.TOKEN_REVOCATION_STORE_URL)
+)
 
 
 def generate_token(user_id: int):
@@ -19,16 +108,18 @@ def generate_token(user_id: int):
         'token_type': 'access',
         'exp': datetime.utcnow() + timedelta(minutes=30),
         'user_id': user_id,
-        'jti': jti_access
+        'jti': jti_access,
+        # lets /logout revoke the refresh token along with this one
+        'refresh_jti': jti_refresh
     }
     data_refresh_token = {
         'token_type': 'refresh',
-        'exp': datetime.utcnow() + timedelta(days=1),
+        'exp': datetime.utcnow() + REFRESH_TOKEN_LIFETIME,
         'user_id': user_id,
         'jti': jti_refresh
     }
-    access_token = jwt.encode(data_access_token, secret_key, algorithm)
-    refresh_token = jwt.encode(data_refresh_token, secret_key, algorithm)
+    access_token = verifier.encode(data_access_token)
+    refresh_token = verifier.encode(data_refresh_token)
 
     return {
         'access_token': access_token,
@@ -36,12 +127,14 @@ def generate_token(user_id: int):
     }
 
 
+def decode_token(token: str) -> dict:
+    return verifier.decode(token)
+
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
-        secret_key = os.environ.get('SECRET')
-
-        payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+        payload = decode_token(token)
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
@@ -51,5 +144,5 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 
 def create_reset_password_token(email: str):
     data = {"sub": email, "exp": datetime.utcnow() + timedelta(minutes=10)}
-    token = jwt.encode(data, secret_key, algorithm)
+    token = verifier.encode(data)
     return token
@@ -0,0 +1,52 @@
+"""Compare two ``bench.run`` result files.
+
+    python -m bench.compare bench/results/before.json bench/results/after.json --fail-over 10
+
+Prints p50, p99 and throughput per scenario with the relative change;
+with ``--fail-over PCT`` exits 1 when a p99 grew or a throughput shrank by
+more than PCT percent, so it can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--fail-over', type=float, help='regression threshold in percent')
+    args = parser.parse_args(argv)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+
+    regressions = []
+    print(f"{'scenario':>13} {'p50 ms':>22} {'p99 ms':>22} {'throughput /s':>26}")
+    for name, old in baseline['results'].items():
+        new = candidate['results'].get(name)
+        if new is None or not (old['count'] and new['count']):
+            continue
+        columns = []
+        for key, worse_when_higher in (('p50_ms', True), ('p99_ms', True), ('throughput', False)):
+            delta = change(old[key], new[key])
+            columns.append(f"{old[key]:9.2f} -> {new[key]:9.2f} {delta:+6.1f}%")
+            worse = delta if worse_when_higher else -delta
+            if args.fail_over is not None and key != 'p50_ms' and worse > args.fail_over:
+                regressions.append(f'{name} {key} {delta:+.1f}%')
+        print(f'{name:>13} ' + ' '.join(columns))
+    old_rss, new_rss = baseline['rss_mb'].get('max'), candidate['rss_mb'].get('max')
+    if old_rss and new_rss:
+        print(f"{'rss max MB':>13} {old_rss:9.1f} -> {new_rss:9.1f} {change(old_rss, new_rss):+6.1f}%")
+    if regressions:
+        print('regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import orjson
+import websockets
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    """Latencies and failures of one kind of operation."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        # not fired because too many were already in flight
+        self.skipped = 0
+        self.statuses: Dict[str, int] = {}
+
+    def add(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def fail(self, reason: str):
+        self.errors += 1
+        self.statuses[reason] = self.statuses.get(reason, 0) + 1
+
+    def reset(self):
+        self.latencies.clear()
+        self.errors = 0
+        self.skipped = 0
+        self.statuses.clear()
+
+    def summary(self, duration: float) -> dict:
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        return {
+            'count': count,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'failures': dict(self.statuses),
+            'throughput': count / duration if duration else 0.0,
+            'mean_ms': sum(ordered) / count * 1000 if count else 0.0,
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p90_ms': percentile(ordered, 0.90) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'max_ms': ordered[-1] * 1000 if count else 0.0,
+        }
+
+
+async def paced(rate: float, duration: float, fire: Callable[[], None]):
+    """Call ``fire`` ``rate`` times a second for ``duration`` seconds.
+
+    Open loop: ticks are due on a fixed schedule whatever the server's
+    latency, so a slow server shows up as latency instead of as a lower
+    request rate.
+    """
+    if rate <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    fired = 0
+    while True:
+        elapsed = loop.time() - start
+        if elapsed >= duration:
+            return
+        due = min(int(elapsed * rate) + 1, int(duration * rate))
+        while fired < due:
+            fire()
+            fired += 1
+        await asyncio.sleep(max(0.0, start + fired / rate - loop.time()))
+
+
+class RoomClients:
+    """Sockets on ``/ws/{room}``; every chat message received is a delivery sample.
+
+    Message bodies carry the sender's ``perf_counter``, so delivery latency
+    is measured on one clock: senders and receivers live in this process.
+    """
+
+    def __init__(self, url: str, deliveries: Recorder, connects: Recorder, compression: Optional[str] = 'deflate'):
+        self.url = url.replace('http://', 'ws://').replace('https://', 'wss://')
+        self.deliveries = deliveries
+        self.connects = connects
+        self.compression = compression
+        self.rooms: Dict[str, List] = {}
+        self.sent = 0
+        self._tasks: List[asyncio.Task] = []
+
+    async def open(self, room: str, token: str, slots: asyncio.Semaphore):
+        async with slots:
+            started = time.perf_counter()
+            try:
+                websocket = await websockets.connect(
+                    f'{self.url}/ws/{room}?token={token}',
+                    subprotocols=['chat.v1.json'],
+                    compression=self.compression,
+                    max_queue=None,
+                    open_timeout=30,
+                )
+            except Exception as e:
+                self.connects.fail(type(e).__name__)
+                return
+            self.connects.add(time.perf_counter() - started)
+        self.rooms.setdefault(room, []).append(websocket)
+        self._tasks.append(asyncio.create_task(self._receive(websocket)))
+
+    async def _receive(self, websocket):
+        deliveries = self.deliveries
+        try:
+            async for frame in websocket:
+                envelope = orjson.loads(frame)
+                kind = envelope.get('type')
+                if kind == 'message':
+                    deliveries.add(time.perf_counter() - float(envelope['body']))
+                elif kind == 'ping':
+                    await websocket.send(orjson.dumps({'type': 'pong'}).decode())
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is None or e.rcvd.code not in (1000, 1001):
+                deliveries.fail(f'closed {e.rcvd.code if e.rcvd else "abnormally"}')
+
+    def send_one(self):
+        """Post a message from a random socket of a random room."""
+        room = random.choice(self.room_keys)
+        websocket = random.choice(self.rooms[room])
+        body = f'{time.perf_counter():.9f}'
+        asyncio.ensure_future(self._send(websocket, body))
+
+    async def _send(self, websocket, body: str):
+        try:
+            await websocket.send(orjson.dumps({'type': 'message', 'body': body}).decode())
+            self.sent += 1
+        except websockets.ConnectionClosed:
+            self.deliveries.fail('send on closed socket')
+
+    @property
+    def room_keys(self) -> List[str]:
+        return list(self.rooms)
+
+    @property
+    def count(self) -> int:
+        return sum(len(sockets) for sockets in self.rooms.values())
+
+    async def close(self):
+        await asyncio.gather(
+            *(websocket.close() for sockets in self.rooms.values() for websocket in sockets),
+            return_exceptions=True,
+        )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class HttpDriver:
+    """Fires one kind of request on a schedule, at most ``max_inflight`` at a time."""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, make_request: Callable[[], dict], max_inflight: int):
+        self.client = client
+        self.recorder = recorder
+        self.make_request = make_request
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._tasks = set()
+
+    def fire(self):
+        if self.inflight >= self.max_inflight:
+            self.recorder.skipped += 1
+            return
+        self.inflight += 1
+        task = asyncio.ensure_future(self._request(self.make_request()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _request(self, request: dict):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(**request)
+        except httpx.HTTPError as e:
+            self.recorder.fail(type(e).__name__)
+            return
+        finally:
+            self.inflight -= 1
+        if response.status_code >= 400:
+            self.recorder.fail(str(response.status_code))
+        else:
+            self.recorder.add(time.perf_counter() - started)
+
+    async def drain(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
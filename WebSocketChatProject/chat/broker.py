@@ -0,0 +1,326 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+Frame = Union[str, bytes]
+Handler = Callable[[str, Frame], Awaitable[None]]
+
+
+class Broker:
+    """Relays room frames between worker processes.
+
+    The manager delivers frames published by its own process itself, so a
+    broker only has to hand it frames that originate somewhere else.
+    ``subscribe``/``unsubscribe`` are called when a room gains its first or
+    loses its last local connection. Room sequence numbers and presence
+    counts come from the broker too, since every worker has to see the
+    same numbers; the base class counts in memory.
+    """
+
+    def __init__(self):
+        self.seqs: Dict[str, int] = {}
+        self.presence: Dict[str, Dict[int, int]] = {}
+
+    async def start(self, handler: Handler):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, room: str):
+        pass
+
+    def unsubscribe(self, room: str):
+        pass
+
+    async def publish(self, room: str, message: Frame):
+        pass
+
+    async def next_seq(self, room: str) -> int:
+        seq = self.seqs[room] = self.seqs.get(room, 0) + 1
+        return seq
+
+    async def current_seq(self, room: str) -> int:
+        return self.seqs.get(room, 0)
+
+    async def track_presence(self, room: str, user_id: int, delta: int) -> int:
+        """Add ``delta`` to the user's connection count in ``room`` and return it."""
+        users = self.presence.setdefault(room, {})
+        count = users.get(user_id, 0) + delta
+        if count > 0:
+            users[user_id] = count
+        else:
+            users.pop(user_id, None)
+            if not users:
+                del self.presence[room]
+        return count
+
+    async def online(self, room: str) -> List[int]:
+        return list(self.presence.get(room, ()))
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBroker(Broker):
+    """Single-process default: every subscriber is local, nothing to relay."""
+
+
+class RedisBroker(Broker):
+    """Redis pub/sub backplane, one channel per room.
+
+    Publishes are queued and sent in pipelined batches by a writer task,
+    subscription changes are applied by the reader task, so neither
+    ``publish`` nor ``join``/``leave`` ever wait on Redis. Any client with
+    the ``redis.asyncio`` interface works (e.g. ``fakeredis.aioredis``).
+
+    Presence counts are kept per worker, as ``<node id>:<user id>`` fields
+    of the room's hash, and each worker refreshes a heartbeat key. Only
+    the fields of workers whose heartbeat is alive are summed, so the
+    sockets of a worker that crashed stop counting once its heartbeat
+    expires, even in a room that stays busy.
+    """
+
+    def __init__(
+            self,
+            url: Optional[str] = None,
+            client=None,
+            prefix: str = 'chat:room:',
+            max_pending: int = 10000,
+            poll_interval: float = 0.05,
+            seq_prefix: str = 'chat:seq:',
+            presence_prefix: str = 'chat:presence:',
+            presence_ttl: int = 24 * 3600,
+            node_prefix: str = 'chat:node:',
+            heartbeat_interval: float = 5.0
+    ):
+        super().__init__()
+        if client is None:
+            try:
+                from redis import asyncio as aioredis
+            except ImportError:
+                raise RuntimeError('RedisBroker requires the "redis" package')
+            client = aioredis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.seq_prefix = seq_prefix
+        self.presence_prefix = presence_prefix
+        # counts of a worker that died without cleaning up expire eventually
+        self.presence_ttl = presence_ttl
+        self.poll_interval = poll_interval
+        self.node_id = uuid.uuid4().hex.encode()
+        self.node_prefix = node_prefix
+        self.nodes_key = node_prefix + 'all'
+        self.heartbeat_interval = heartbeat_interval
+        # a worker missing this many heartbeats in a row counts as gone
+        self.node_ttl = max(1, int(heartbeat_interval * 3))
+        # workers with a live heartbeat, refreshed with every beat of ours
+        self.live_nodes: Set[bytes] = {self.node_id}
+        self.wanted: Set[str] = set()
+        self.subscribed: Set[str] = set()
+        self.outbox: Deque[Tuple[str, bytes]] = deque(maxlen=max_pending)
+        self.published = 0
+        self.relayed = 0
+        self.dropped = 0
+        self.batches = 0
+        self._handler: Optional[Handler] = None
+        self._pubsub = None
+        self._changed: Optional[asyncio.Event] = None
+        self._pending: Optional[asyncio.Event] = None
+        self._tasks = []
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+        self._pubsub = self.client.pubsub()
+        self._changed = asyncio.Event()
+        self._pending = asyncio.Event()
+        if self.wanted:
+            self._changed.set()
+        self._tasks = [
+            asyncio.create_task(self._read()),
+            asyncio.create_task(self._write()),
+            asyncio.create_task(self._heartbeat()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self._flush()
+        except Exception:
+            logger.exception('Redis broker could not flush pending publishes')
+        if self._pubsub is not None:
+            await self._pubsub.close()
+        try:
+            await self.client.delete(self.node_prefix + self.node_id.decode())
+            await self.client.srem(self.nodes_key, self.node_id)
+        except Exception:
+            logger.exception('Redis broker could not remove its heartbeat')
+        await self.client.close()
+
+    def subscribe(self, room: str):
+        self.wanted.add(room)
+        if self._changed is not None:
+            self._changed.set()
+
+    def unsubscribe(self, room: str):
+        self.wanted.discard(room)
+        if self._changed is not None:
+            self._changed.set()
+
+    async def publish(self, room: str, message: Frame):
+        if isinstance(message, bytes):
+            payload = self.node_id + b'b' + message
+        else:
+            payload = self.node_id + b't' + message.encode()
+        if len(self.outbox) == self.outbox.maxlen:
+            self.dropped += 1
+        self.outbox.append((self.prefix + room, payload))
+        if self._pending is not None:
+            self._pending.set()
+
+    async def next_seq(self, room: str) -> int:
+        return await self.client.incr(self.seq_prefix + room)
+
+    async def current_seq(self, room: str) -> int:
+        return int(await self.client.get(self.seq_prefix + room) or 0)
+
+    async def track_presence(self, room: str, user_id: int, delta: int) -> int:
+        key = self.presence_prefix + room
+        nodes = list(self.live_nodes)
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hincrby(key, b'%s:%d' % (self.node_id, user_id), delta)
+        pipeline.expire(key, self.presence_ttl)
+        pipeline.hmget(key, [b'%s:%d' % (node, user_id) for node in nodes])
+        _, _, counts = await pipeline.execute()
+        # zero counts stay in the hash; deleting them would race with this
+        # worker's next increment
+        return sum(max(0, int(count)) for count in counts if count is not None)
+
+    async def online(self, room: str) -> List[int]:
+        counts = await self.client.hgetall(self.presence_prefix + room)
+        online = set()
+        for field, count in counts.items():
+            node, _, user_id = field.rpartition(b':')
+            if node in self.live_nodes and int(count) > 0:
+                online.add(int(user_id))
+        return list(online)
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.beat()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Redis broker heartbeat failed')
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def beat(self):
+        """Refresh this worker's heartbeat and find out which workers are alive."""
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(self.node_prefix + self.node_id.decode(), 1, ex=self.node_ttl)
+        pipeline.sadd(self.nodes_key, self.node_id)
+        pipeline.smembers(self.nodes_key)
+        _, _, nodes = await pipeline.execute()
+        nodes = list(nodes)
+        pipeline = self.client.pipeline(transaction=False)
+        for node in nodes:
+            pipeline.exists(self.node_prefix + node.decode())
+        alive = await pipeline.execute()
+        dead = [node for node, exists in zip(nodes, alive) if not exists]
+        if dead:
+            await self.client.srem(self.nodes_key, *dead)
+        self.live_nodes = {node for node, exists in zip(nodes, alive) if exists} | {self.node_id}
+
+    async def _sync_subscriptions(self):
+        self._changed.clear()
+        added = self.wanted - self.subscribed
+        removed = self.subscribed - self.wanted
+        if added:
+            await self._pubsub.subscribe(*(self.prefix + room for room in added))
+            self.subscribed |= added
+        if removed:
+            await self._pubsub.unsubscribe(*(self.prefix + room for room in removed))
+            self.subscribed -= removed
+
+    async def _read(self):
+        while True:
+            try:
+                if self._changed.is_set():
+                    await self._sync_subscriptions()
+                if not self.subscribed:
+                    await self._changed.wait()
+                    continue
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=self.poll_interval
+                )
+                if message is not None and message['type'] == 'message':
+                    await self._dispatch(message['channel'], message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Redis broker read failed')
+                await asyncio.sleep(1)
+
+    async def _dispatch(self, channel: bytes, data: bytes):
+        node_length = len(self.node_id)
+        if data[:node_length] == self.node_id:
+            return
+        room = channel.decode()[len(self.prefix):]
+        kind = data[node_length:node_length + 1]
+        message = data[node_length + 1:]
+        self.relayed += 1
+        await self._handler(room, message if kind == b'b' else message.decode())
+
+    async def _write(self):
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            try:
+                await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Redis broker publish failed')
+                await asyncio.sleep(1)
+
+    async def _flush(self):
+        outbox = self.outbox
+        while outbox:
+            batch = [outbox.popleft() for _ in range(len(outbox))]
+            pipeline = self.client.pipeline(transaction=False)
+            for channel, payload in batch:
+                pipeline.publish(channel, payload)
+            try:
+                await pipeline.execute()
+            except Exception:
+                self.dropped += len(batch)
+                raise
+            self.published += len(batch)
+            self.batches += 1
+
+    def stats(self) -> dict:
+        return {
+            'subscribed': len(self.subscribed),
+            'pending': len(self.outbox),
+            'published': self.published,
+            'live_nodes': len(self.live_nodes),
+            'relayed': self.relayed,
+            'dropped': self.dropped,
+            'batches': self.batches,
+        }
+
+
+def make_broker(url: Optional[str]) -> Broker:
+    if not url or url.startswith('memory://'):
+        return MemoryBroker()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBroker(url)
+    raise ValueError(f'Unsupported broker url: {url}')
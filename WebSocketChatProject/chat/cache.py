@@ -0,0 +1,198 @@
+import hashlib
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+ConversationKey = Tuple[int, int]
+
+# rough per-message overhead of the cached dict on top of the text itself
+MESSAGE_OVERHEAD = 200
+
+
+def conversation_key(user_id: int, other_id: int) -> ConversationKey:
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def room_key(user_id: int, other_id: int) -> str:
+    """Canonical room key of a user pair, the same whoever opens the chat first."""
+    low, high = conversation_key(user_id, other_id)
+    return hashlib.sha256(f'{low}:{high}'.encode()).hexdigest()
+
+
+def message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD + len(message.get('message') or '')
+
+
+class _Entry:
+    __slots__ = ('messages', 'complete', 'expires', 'size')
+
+    def __init__(self, messages: Deque[dict], complete: bool, expires: float):
+        self.messages = messages
+        self.complete = complete
+        self.expires = expires
+        self.size = sum(message_size(message) for message in messages)
+
+
+class HistoryCache:
+    """Newest messages of recently opened conversations, in this process.
+
+    An entry is seeded from a first-page database read and from then on
+    every message saved by this process is appended to it. Entries are
+    bounded by count (LRU), by age and by an approximate byte budget.
+    Only a single process sees every save: with several workers a message
+    saved by another one shows up once the entry expires, which is why
+    ``main`` caps the TTL to a couple of seconds behind a shared broker.
+    """
+
+    def __init__(
+            self,
+            max_conversations: int = 10000,
+            per_conversation: int = 50,
+            ttl: float = 300,
+            max_bytes: int = 64 * 1024 * 1024
+    ):
+        self.max_conversations = max_conversations
+        self.per_conversation = per_conversation
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[ConversationKey, _Entry]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # fills in flight per conversation; a write that lands while the
+        # database is being read marks them stale
+        self._fills: Dict[ConversationKey, List[list]] = {}
+
+    def get(self, key: ConversationKey, limit: int) -> Optional[Tuple[List[dict], bool]]:
+        """Return ``(newest-first messages, has_more)`` or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires < time.monotonic():
+            self._remove(key)
+            self.evictions += 1
+            entry = None
+        if entry is None or (len(entry.messages) < limit and not entry.complete):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        messages = entry.messages
+        items = [messages[index] for index in range(len(messages) - 1, max(len(messages) - limit, 0) - 1, -1)]
+        has_more = len(messages) > limit or not entry.complete
+        return items, has_more
+
+    def begin_fill(self, key: ConversationKey) -> list:
+        token = [True]
+        self._fills.setdefault(key, []).append(token)
+        return token
+
+    def end_fill(self, key: ConversationKey, token: list, newest_first: Optional[List[dict]] = None, complete: bool = False):
+        """Seed ``key`` from a first-page read; pass no rows to just abandon the fill."""
+        fills = self._fills.get(key)
+        if fills is not None:
+            fills.remove(token)
+            if not fills:
+                del self._fills[key]
+        if newest_first is None or not token[0] or key in self.entries:
+            return
+        messages = deque(reversed(newest_first[:self.per_conversation]), maxlen=self.per_conversation)
+        complete = complete and len(newest_first) <= self.per_conversation
+        entry = _Entry(messages, complete, time.monotonic() + self.ttl)
+        self.entries[key] = entry
+        self.size += entry.size
+        self._evict()
+
+    def append(self, messages: Iterable[dict]):
+        """Add freshly saved messages (dicts with at least id, sender_id, receiver_id)."""
+        for message in sorted(messages, key=lambda item: item['id']):
+            if message['receiver_id'] is None:
+                # group messages, their history is not cached
+                continue
+            key = conversation_key(message['sender_id'], message['receiver_id'])
+            for token in self._fills.get(key, ()):
+                token[0] = False
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            cached = entry.messages
+            if cached and cached[-1]['id'] >= message['id']:
+                continue
+            if len(cached) == cached.maxlen:
+                dropped = message_size(cached[0])
+                entry.size -= dropped
+                self.size -= dropped
+                entry.complete = False
+            cached.append(message)
+            added = message_size(message)
+            entry.size += added
+            self.size += added
+        self._evict()
+
+    def _remove(self, key: ConversationKey):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    def _evict(self):
+        entries = self.entries
+        while entries and (len(entries) > self.max_conversations or self.size > self.max_bytes):
+            key = next(iter(entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'conversations': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _slot(room: dict):
+    # group rooms have no user pair, they are only found by key
+    if room.get('is_group'):
+        return room['key']
+    return conversation_key(room['sender_id'], room['receiver_id'])
+
+
+class RoomCache:
+    """Rooms by user pair and by key, so opening a chat skips the database."""
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.by_pair: 'OrderedDict[object, dict]' = OrderedDict()
+        self.by_key: Dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_pair(self, user_id: int, other_id: int) -> Optional[dict]:
+        return self._hit(conversation_key(user_id, other_id))
+
+    def get_key(self, key: str) -> Optional[dict]:
+        room = self.by_key.get(key)
+        if room is None:
+            self.misses += 1
+            return None
+        return self._hit(_slot(room))
+
+    def _hit(self, slot) -> Optional[dict]:
+        room = self.by_pair.get(slot)
+        if room is None:
+            self.misses += 1
+            return None
+        self.by_pair.move_to_end(slot)
+        self.hits += 1
+        return room
+
+    def put(self, room: dict):
+        slot = _slot(room)
+        self.by_pair[slot] = room
+        self.by_pair.move_to_end(slot)
+        self.by_key[room['key']] = room
+        while len(self.by_pair) > self.max_entries:
+            _, evicted = self.by_pair.popitem(last=False)
+            self.by_key.pop(evicted['key'], None)
+
+    def stats(self) -> dict:
+        return {'rooms': len(self.by_pair), 'hits': self.hits, 'misses': self.misses}
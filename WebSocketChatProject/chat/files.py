@@ -0,0 +1,169 @@
+import hashlib
+import os
+import re
+import unicodedata
+import uuid
+from typing import AsyncIterator, Optional
+
+import anyio
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+MAX_FILENAME_LENGTH = 255
+# markup and quoting characters, and those Windows refuses in file names
+UNSAFE_FILENAME_CHARACTERS = re.compile(r'[<>:"/\\|?*\'`&;]')
+
+
+def safe_filename(filename) -> str:
+    """The last path segment of ``filename`` without control, markup or quoting characters.
+
+    The name is echoed to every member of the room and shown by clients,
+    so nothing in it may be read as HTML or break out of a quoted string.
+    """
+    if not isinstance(filename, str):
+        return 'file'
+    name = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    name = ''.join(character for character in name if unicodedata.category(character)[0] != 'C')
+    name = UNSAFE_FILENAME_CHARACTERS.sub('_', name).strip(' .')
+    return name[:MAX_FILENAME_LENGTH] or 'file'
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class Upload:
+    """One file being written to disk chunk by chunk.
+
+    Bytes go to ``<key>.part`` and are hashed on the way; ``commit`` moves
+    the file into place, ``abort`` removes it. Only the current chunk is
+    ever held in memory.
+    """
+
+    def __init__(self, store: 'FileStore', filename: str, content_type: Optional[str], expected_size: Optional[int]):
+        self.store = store
+        self.filename = safe_filename(filename)
+        self.content_type = content_type or DEFAULT_CONTENT_TYPE
+        self.expected_size = expected_size
+        name = uuid.uuid4().hex
+        # two-level layout keeps directories small
+        self.storage_key = f'{name[:2]}/{name}'
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._path = store.path(self.storage_key)
+        self._file = None
+
+    @property
+    def complete(self) -> bool:
+        return self.expected_size is not None and self.size >= self.expected_size
+
+    async def open(self):
+        await anyio.Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = await anyio.open_file(f'{self._path}.part', 'wb')
+        self.store.in_progress += 1
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        limit = self.expected_size if self.expected_size is not None else self.store.max_size
+        if self.size > limit:
+            raise FileTooLarge(f'File is larger than {limit} bytes')
+        self._digest.update(chunk)
+        await self._file.write(chunk)
+
+    async def commit(self) -> dict:
+        await self._close()
+        await anyio.Path(f'{self._path}.part').rename(self._path)
+        self.store.uploads += 1
+        self.store.bytes_written += self.size
+        return {
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'sha256': self._digest.hexdigest(),
+            'storage_key': self.storage_key,
+        }
+
+    async def abort(self):
+        await self._close()
+        await anyio.Path(f'{self._path}.part').unlink(missing_ok=True)
+        self.store.aborted += 1
+
+    async def _close(self):
+        if self._file is not None:
+            await self._file.aclose()
+            self._file = None
+            self.store.in_progress -= 1
+
+
+class FileStore:
+    """Attachments on the local disk under ``root``.
+
+    Files are written and read in ``chunk_size`` pieces through anyio's
+    worker threads, so memory use does not depend on the file size and a
+    large transfer never blocks the event loop.
+    """
+
+    def __init__(self, root: str, chunk_size: int = 64 * 1024, max_size: int = 100 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.in_progress = 0
+        self.uploads = 0
+        self.aborted = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def path(self, storage_key: str) -> str:
+        return os.path.join(self.root, storage_key)
+
+    async def begin(
+            self,
+            filename: str,
+            content_type: Optional[str] = None,
+            expected_size: Optional[int] = None
+    ) -> Upload:
+        if expected_size is not None and expected_size > self.max_size:
+            raise FileTooLarge(f'File is larger than {self.max_size} bytes')
+        upload = Upload(self, filename, content_type, expected_size)
+        await upload.open()
+        return upload
+
+    async def save(
+            self,
+            chunks: AsyncIterator[bytes],
+            filename: str,
+            content_type: Optional[str] = None,
+            expected_size: Optional[int] = None
+    ) -> dict:
+        """Write a streamed body to disk and return the stored file's metadata."""
+        upload = await self.begin(filename, content_type, expected_size)
+        try:
+            async for chunk in chunks:
+                if chunk:
+                    await upload.write(chunk)
+            if expected_size is not None and upload.size != expected_size:
+                raise ValueError(f'Expected {expected_size} bytes, got {upload.size}')
+        except BaseException:
+            await upload.abort()
+            raise
+        return await upload.commit()
+
+    async def read(self, storage_key: str) -> AsyncIterator[bytes]:
+        async with await anyio.open_file(self.path(storage_key), 'rb') as file:
+            while True:
+                chunk = await file.read(self.chunk_size)
+                if not chunk:
+                    return
+                self.bytes_read += len(chunk)
+                yield chunk
+
+    async def delete(self, storage_key: str):
+        await anyio.Path(self.path(storage_key)).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            'in_progress': self.in_progress,
+            'uploads': self.uploads,
+            'aborted': self.aborted,
+            'bytes_written': self.bytes_written,
+            'bytes_read': self.bytes_read,
+        }
@@ -0,0 +1,507 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+from starlette import status
+
+from .broker import Broker, Frame, MemoryBroker
+from .protocol import JSON, LEFT, MEMBERS, PING, SYNC, TEXT, Codec, Packet
+from .replay import ReplayBuffer
+
+logger = logging.getLogger(__name__)
+
+# What to do when a connection's outbound queue is full
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class Connection:
+    __slots__ = (
+        'websocket', 'user_id', 'expires', 'allowed', 'codec', 'rooms', 'acked', 'queue', 'max_queue',
+        'overflow', 'sent', 'dropped', 'closed', 'connected_at', 'last_seen', 'last_progress', 'pinged',
+        '_wakeup', '_writer',
+    )
+
+    def __init__(
+            self,
+            websocket: WebSocket,
+            user_id: Optional[int] = None,
+            max_queue: int = 256,
+            overflow: str = DROP_OLDEST,
+            codec: Codec = TEXT
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.websocket = websocket
+        self.user_id = user_id
+        # set from the handshake token: when it runs out, and the rooms the
+        # user was already checked against (room key -> (room id, peer id),
+        # no peer in group rooms)
+        self.expires: Optional[float] = None
+        self.allowed: Dict[str, Tuple[int, Optional[int]]] = {}
+        self.codec = codec
+        self.rooms: Set[str] = set()
+        # highest seq the client confirmed, per room
+        self.acked: Dict[str, int] = {}
+        self.queue: Deque[Tuple[Optional[str], Frame]] = deque()
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        # monotonic times: accepted, last frame received, and last time the
+        # writer sent a frame or had nothing left to send
+        self.connected_at = self.last_seen = self.last_progress = time.monotonic()
+        self.pinged = 0.0
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self, on_error: Callable[['Connection'], Awaitable[None]]):
+        self._writer = asyncio.create_task(self._drain(on_error))
+
+    def enqueue(self, message: Frame, key: Optional[str] = None) -> bool:
+        """Queue a frame for the writer task without waiting on the socket.
+
+        ``key`` marks frames that supersede each other (typing, presence);
+        under the coalesce policy a newer frame replaces a pending one with
+        the same key. Returns False when the consumer is too slow and the
+        disconnect policy applies.
+        """
+        if self.closed:
+            return True
+        queue = self.queue
+        if key is not None and self.overflow == COALESCE:
+            for index, (pending_key, _) in enumerate(queue):
+                if pending_key == key:
+                    queue[index] = (key, message)
+                    self.dropped += 1
+                    return True
+        if len(queue) >= self.max_queue:
+            if self.overflow == DISCONNECT:
+                return False
+            queue.popleft()
+            self.dropped += 1
+        elif not queue:
+            self.last_progress = time.monotonic()
+        queue.append((key, message))
+        self._wakeup.set()
+        return True
+
+    async def _drain(self, on_error: Callable[['Connection'], Awaitable[None]]):
+        websocket = self.websocket
+        queue = self.queue
+        try:
+            while True:
+                while not queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, message = queue.popleft()
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+                self.sent += 1
+                self.last_progress = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await on_error(self)
+
+    def seen(self):
+        self.last_seen = time.monotonic()
+
+    @property
+    def stalled_since(self) -> Optional[float]:
+        """When the writer last got a frame out, if frames are waiting on it."""
+        return self.last_progress if self.queue else None
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        writer = self._writer
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
+
+class WebSocketManager:
+    """Connection registry indexed by room and by user.
+
+    Join, leave and disconnect are set operations, so a broadcast only
+    touches the sockets of its own room. Every connection has its own
+    bounded send queue and writer task, so fan-out never waits on a socket.
+    Frames are also handed to the broker, which relays them to the same
+    room in other worker processes. Envelopes are broadcast as ``Packet``s,
+    encoded once per codec and shared by every socket using that codec.
+
+    Sequenced packets (chat messages, files) get the room's next seq and
+    are kept in a replay buffer; a client that reconnects with the last
+    seq it saw gets exactly what it missed, or a sync marker when the gap
+    is no longer buffered. Acked seqs are remembered per user and room, so
+    a client that lost its position can ask to resume from its last ack.
+
+    Group rooms also keep their member ids here, loaded once by whoever
+    brings the room's first local socket in and dropped with its last one.
+    Member changes travel as ``members`` packets through the room, so every
+    worker with sockets in it updates its set and removes the sockets of
+    removed members.
+
+    A reaper task sweeps the connections every ``reap_interval`` seconds:
+    sockets quiet for ``ping_interval`` get a ping envelope, sockets that
+    sent nothing for ``idle_timeout`` (not even the pong) and sockets whose
+    writer made no progress for ``send_timeout`` are closed, so half-open
+    sockets don't hold slots until a send to them happens to fail. Plain
+    text sockets can't answer pings; they rely on the server's protocol
+    level pings (uvicorn ``--ws-ping-interval``) and on the send timeout.
+    """
+
+    def __init__(
+            self,
+            max_connections: int = 10000,
+            max_room_connections: int = 500,
+            send_queue_size: int = 256,
+            overflow: str = DROP_OLDEST,
+            broker: Optional[Broker] = None,
+            replay_size: int = 256,
+            replay_rooms: int = 10000,
+            resume_points: int = 100000,
+            ping_interval: float = 25.0,
+            idle_timeout: float = 75.0,
+            send_timeout: float = 30.0,
+            reap_interval: float = 5.0
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.broker = broker if broker is not None else MemoryBroker()
+        self.max_connections = max_connections
+        self.max_room_connections = max_room_connections
+        self.send_queue_size = send_queue_size
+        self.overflow = overflow
+        self.connections: Set[Connection] = set()
+        self.rooms: Dict[str, Set[Connection]] = {}
+        self.users: Dict[int, Set[Connection]] = {}
+        # member user ids of the group rooms that have local connections
+        self.members: Dict[str, Set[int]] = {}
+        self.replay = ReplayBuffer(replay_size, replay_rooms)
+        self.max_resume_points = resume_points
+        self.resume_points: 'OrderedDict[Tuple[int, str], int]' = OrderedDict()
+        self.syncs = 0
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.send_timeout = send_timeout
+        self.reap_interval = reap_interval
+        # called with (room, user id) for every room a closing connection was in
+        self.on_leave: Optional[Callable[[str, int], Awaitable[None]]] = None
+        # called with (recipients, seconds) after every local fan-out
+        self.on_fan_out: Optional[Callable[[int, float], None]] = None
+        self.pings = 0
+        self.reaped_idle = 0
+        self.reaped_stalled = 0
+        self.reaped_expired = 0
+        self.closed_connections = 0
+        self.closed_lifetime = 0.0
+        self.max_lifetime = 0.0
+        self._reaper: Optional[asyncio.Task] = None
+        # counters carried over from connections that are already gone
+        self.closed_sent = 0
+        self.closed_dropped = 0
+        self.slow_disconnects = 0
+
+    async def start(self):
+        await self.broker.start(self._relay)
+        self._reaper = asyncio.create_task(self._reap_forever())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        for connection in tuple(self.connections):
+            await self.disconnect(connection, code=status.WS_1001_GOING_AWAY)
+        await self.broker.stop()
+
+    def room_size(self, room: str) -> int:
+        return len(self.rooms.get(room, ()))
+
+    async def connect(
+            self,
+            websocket: WebSocket,
+            room: Optional[str] = None,
+            user_id: Optional[int] = None,
+            codec: Codec = TEXT,
+            subprotocol: Optional[str] = None,
+            last_seq: Optional[int] = None,
+            resume: bool = False
+    ) -> Optional[Connection]:
+        """Accept ``websocket`` and, when given, put it in ``room`` right away.
+
+        Without a room the connection only joins rooms through ``enter``.
+        """
+        if len(self.connections) >= self.max_connections or (
+                room is not None and self.room_size(room) >= self.max_room_connections):
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            return None
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, user_id, self.send_queue_size, self.overflow, codec)
+        connection.start(self.disconnect)
+        self.connections.add(connection)
+        if user_id is not None:
+            self.users.setdefault(user_id, set()).add(connection)
+        if room is not None:
+            await self.enter(connection, room, last_seq, resume)
+        return connection
+
+    async def enter(
+            self,
+            connection: Connection,
+            room: str,
+            last_seq: Optional[int] = None,
+            resume: bool = False,
+            members: Optional[Set[int]] = None,
+            max_connections: Optional[int] = None
+    ) -> bool:
+        """Join ``room`` and replay what the client missed since ``last_seq``.
+
+        ``members`` are the user ids of a group room, kept unless the room
+        already has a set.
+        """
+        if last_seq is None and resume and connection.user_id is not None:
+            last_seq = self.resume_points.get((connection.user_id, room))
+        if connection.closed or not self.join(connection, room, max_connections):
+            return False
+        if members is not None:
+            self.members.setdefault(room, members)
+        if last_seq is not None:
+            await self.resume(connection, room, last_seq)
+        return True
+
+    async def resume(self, connection: Connection, room: str, last_seq: int):
+        """Replay what the client missed since ``last_seq``, or send a sync marker.
+
+        Runs right after the join, so everything published from then on is
+        delivered live; the buffered packets are queued before the first
+        await and stay ahead of it. The room's seq is read only then: any
+        seq up to it the buffer can't account for, lost or still on its
+        way from another worker, gets the client a sync.
+        """
+        missed = self.replay.since(room, last_seq, connection.max_queue)
+        for packet in missed or ():
+            frame = packet.frame(connection.codec)
+            if frame is not None:
+                connection.enqueue(frame)
+        current_seq = await self.broker.current_seq(room)
+        if missed is not None and last_seq <= current_seq and self.replay.covers(room, last_seq, current_seq):
+            return
+        # too far behind, or the counter was reset
+        self.syncs += 1
+        frame = Packet.build(SYNC, room=room, seq=current_seq).frame(connection.codec)
+        if frame is not None:
+            connection.enqueue(frame)
+
+    def ack(self, connection: Connection, room: str, seq: int):
+        if seq > connection.acked.get(room, 0):
+            connection.acked[room] = seq
+
+    def join(self, connection: Connection, room: str, max_connections: Optional[int] = None) -> bool:
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+            self.broker.subscribe(room)
+        elif connection not in members and len(members) >= (max_connections or self.max_room_connections):
+            return False
+        members.add(connection)
+        connection.rooms.add(room)
+        return True
+
+    def leave(self, connection: Connection, room: str):
+        connection.rooms.discard(room)
+        members = self.rooms.get(room)
+        if members is None:
+            return
+        members.discard(connection)
+        if not members:
+            del self.rooms[room]
+            self.members.pop(room, None)
+            self.broker.unsubscribe(room)
+
+    async def disconnect(self, connection: Connection, code: Optional[int] = None):
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        connection.stop()
+        self.closed_sent += connection.sent
+        self.closed_dropped += connection.dropped
+        lifetime = time.monotonic() - connection.connected_at
+        self.closed_connections += 1
+        self.closed_lifetime += lifetime
+        self.max_lifetime = max(self.max_lifetime, lifetime)
+        rooms = tuple(connection.rooms)
+        for room in rooms:
+            self.leave(connection, room)
+        if connection.user_id is not None:
+            self._remember(connection)
+            user_connections = self.users.get(connection.user_id)
+            if user_connections is not None:
+                user_connections.discard(connection)
+                if not user_connections:
+                    del self.users[connection.user_id]
+        if code is not None:
+            try:
+                await connection.websocket.close(code=code)
+            except Exception:
+                pass
+        if self.on_leave is not None and connection.user_id is not None:
+            for room in rooms:
+                try:
+                    await self.on_leave(room, connection.user_id)
+                except Exception:
+                    logger.exception('Leave hook failed for room %s', room)
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Connection reaper failed')
+
+    async def reap(self):
+        """One sweep: ping quiet sockets, close dead, stalled and expired ones."""
+        now = time.monotonic()
+        wall = time.time()
+        ping = None
+        for connection in tuple(self.connections):
+            if connection.closed:
+                continue
+            stalled_since = connection.stalled_since
+            if stalled_since is not None and now - stalled_since >= self.send_timeout:
+                # the peer stopped reading; a close frame would queue behind the rest
+                self.reaped_stalled += 1
+                await self.disconnect(connection, code=status.WS_1011_INTERNAL_ERROR)
+                continue
+            if connection.expires is not None and wall >= connection.expires:
+                self.reaped_expired += 1
+                await self.disconnect(connection, code=status.WS_1008_POLICY_VIOLATION)
+                continue
+            quiet = now - connection.last_seen
+            if quiet < self.ping_interval or now - connection.pinged < self.ping_interval:
+                continue
+            if ping is None:
+                ping = Packet.build(PING, ts=int(wall * 1000))
+            frame = ping.frame(connection.codec)
+            if frame is None:
+                continue
+            if quiet >= self.idle_timeout:
+                self.reaped_idle += 1
+                await self.disconnect(connection, code=status.WS_1001_GOING_AWAY)
+                continue
+            connection.enqueue(frame)
+            connection.pinged = now
+            self.pings += 1
+
+    def _remember(self, connection: Connection):
+        points = self.resume_points
+        for room, seq in connection.acked.items():
+            point = (connection.user_id, room)
+            if seq >= points.get(point, 0):
+                points[point] = seq
+                points.move_to_end(point)
+        while len(points) > self.max_resume_points:
+            points.popitem(last=False)
+
+    async def _fan_out(self, connections, message: Union[Packet, Frame], key: Optional[str] = None):
+        started = time.perf_counter()
+        slow = []
+        if isinstance(message, Packet):
+            for connection in connections:
+                frame = message.frame(connection.codec)
+                if frame is not None and not connection.enqueue(frame, key):
+                    slow.append(connection)
+        else:
+            slow = [connection for connection in connections if not connection.enqueue(message, key)]
+        if self.on_fan_out is not None:
+            self.on_fan_out(len(connections), time.perf_counter() - started)
+        for connection in slow:
+            self.slow_disconnects += 1
+            await self.disconnect(connection, code=status.WS_1008_POLICY_VIOLATION)
+
+    async def deliver(self, room: str, message: Union[Packet, Frame], key: Optional[str] = None):
+        """Fan a frame out to this process's connections in ``room`` only."""
+        await self._fan_out(self.rooms.get(room, ()), message, key)
+
+    async def _relay(self, room: str, frame: Frame):
+        # other workers publish the JSON encoding of their packets
+        packet = Packet.from_json(frame)
+        if packet.fields.get('type') == MEMBERS:
+            await self._apply_members(room, packet)
+            return
+        if 'seq' in packet.fields:
+            self.replay.add(room, packet)
+        await self.deliver(room, packet)
+
+    async def update_members(self, room: str, added: Iterable[int] = (), removed: Iterable[int] = ()):
+        """Announce a membership change of group ``room`` to every worker."""
+        packet = Packet.build(MEMBERS, room=room, added=list(added), removed=list(removed))
+        await self._apply_members(room, packet)
+        await self.broker.publish(room, packet.frame(JSON))
+
+    async def _apply_members(self, room: str, packet: Packet):
+        members = self.members.get(room)
+        removed = packet.fields.get('removed') or ()
+        if members is not None:
+            members.update(packet.fields.get('added') or ())
+            members.difference_update(removed)
+        await self.deliver(room, packet)
+        for user_id in removed:
+            for connection in tuple(self.users.get(user_id, ())):
+                # the room check on entry was cached on the connection
+                connection.allowed.pop(room, None)
+                if room not in connection.rooms:
+                    continue
+                self.leave(connection, room)
+                frame = Packet.build(LEFT, room=room).frame(connection.codec)
+                if frame is not None:
+                    connection.enqueue(frame)
+                if self.on_leave is not None:
+                    await self.on_leave(room, user_id)
+
+    async def broadcast(self, message: Packet, room: str, key: Optional[str] = None, sequenced: bool = False):
+        if sequenced:
+            message.fields['seq'] = await self.broker.next_seq(room)
+            self.replay.add(room, message)
+        await self.deliver(room, message, key)
+        await self.broker.publish(room, message.frame(JSON))
+
+    def stats(self) -> dict:
+        depths = [len(connection.queue) for connection in self.connections]
+        now = time.monotonic()
+        ages = [now - connection.connected_at for connection in self.connections]
+        return {
+            'connections': len(self.connections),
+            'rooms': len(self.rooms),
+            'users': len(self.users),
+            'group_rooms': len(self.members),
+            'group_members': sum(len(members) for members in self.members.values()),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'sent': self.closed_sent + sum(connection.sent for connection in self.connections),
+            'dropped': self.closed_dropped + sum(connection.dropped for connection in self.connections),
+            'slow_disconnects': self.slow_disconnects,
+            'syncs': self.syncs,
+            'resume_points': len(self.resume_points),
+            'replay': self.replay.stats(),
+            'pings': self.pings,
+            'reaped_idle': self.reaped_idle,
+            'reaped_stalled': self.reaped_stalled,
+            'reaped_expired': self.reaped_expired,
+            'closed_connections': self.closed_connections,
+            'avg_lifetime': self.closed_lifetime / self.closed_connections if self.closed_connections else 0.0,
+            'max_lifetime': max(self.max_lifetime, max(ages, default=0.0)),
+            'oldest_connection': max(ages, default=0.0),
+        }
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from .manager import WebSocketManager
+from .protocol import PRESENCE, TYPING, Packet
+
+logger = logging.getLogger(__name__)
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+
+class PresenceService:
+    """Online/offline and typing state per room, announced in batches.
+
+    A user counts as online in a room while they have at least one socket
+    in it, on any worker: the counts live in the broker. Only the 0 -> 1
+    and 1 -> 0 transitions are announced, and they are collected for
+    ``window`` seconds and sent as one presence frame per room, so a user
+    flapping on a bad network costs nothing and a burst of logins costs
+    one frame per affected room. Frames go through the room, i.e. only to
+    users who share it with the subject.
+
+    Typing is local to the worker the typist is connected to; it is
+    announced the same way and stops by itself ``typing_ttl`` seconds
+    after the last typing frame.
+    """
+
+    def __init__(self, manager: WebSocketManager, window: float = 0.25, typing_ttl: float = 6.0):
+        self.manager = manager
+        self.window = window
+        self.typing_ttl = typing_ttl
+        # room -> user -> status waiting for the next flush
+        self.pending: Dict[str, Dict[int, str]] = {}
+        # room -> typing user -> expiry, and rooms whose typists changed
+        self.typists: Dict[str, Dict[int, float]] = {}
+        self.typing_pending: Dict[str, Dict[int, bool]] = {}
+        self.coalesced = 0
+        self.frames = 0
+        self.flushes = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def joined(self, room: str, user_id: int):
+        if await self.manager.broker.track_presence(room, user_id, 1) == 1:
+            self._queue(room, user_id, ONLINE)
+
+    async def left(self, room: str, user_id: int):
+        self.typing(room, user_id, False)
+        if await self.manager.broker.track_presence(room, user_id, -1) <= 0:
+            self._queue(room, user_id, OFFLINE)
+
+    async def snapshot(self, room: str) -> Packet:
+        """Everyone online in ``room``, for a socket that just entered it."""
+        online = await self.manager.broker.online(room)
+        typing = list(self.typists.get(room, ()))
+        return Packet.build(PRESENCE, room=room, online=online, offline=[], typing=typing, snapshot=True)
+
+    def typing(self, room: str, user_id: int, typing: bool):
+        typists = self.typists.get(room)
+        if typing:
+            if typists is None:
+                typists = self.typists[room] = {}
+            started = user_id not in typists
+            typists[user_id] = time.monotonic() + self.typing_ttl
+            if started:
+                self._queue_typing(room, user_id, True)
+        elif typists is not None and typists.pop(user_id, None) is not None:
+            if not typists:
+                del self.typists[room]
+            self._queue_typing(room, user_id, False)
+
+    def _queue(self, room: str, user_id: int, status: str):
+        changes = self.pending.setdefault(room, {})
+        if changes.pop(user_id, None) is not None:
+            # went back before anyone was told
+            self.coalesced += 1
+            if not changes:
+                del self.pending[room]
+        else:
+            changes[user_id] = status
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _queue_typing(self, room: str, user_id: int, typing: bool):
+        changes = self.typing_pending.setdefault(room, {})
+        if changes.pop(user_id, None) is not None:
+            self.coalesced += 1
+            if not changes:
+                del self.typing_pending[room]
+        else:
+            changes[user_id] = typing
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _expire_typing(self):
+        now = time.monotonic()
+        for room, typists in tuple(self.typists.items()):
+            for user_id, expires in tuple(typists.items()):
+                if expires <= now:
+                    self.typing(room, user_id, False)
+
+    async def _run(self):
+        while True:
+            if self.typists:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.typing_ttl)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wakeup.wait()
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Presence flush failed')
+
+    async def flush(self):
+        self._expire_typing()
+        pending, self.pending = self.pending, {}
+        typing_pending, self.typing_pending = self.typing_pending, {}
+        self.flushes += 1
+        for room, changes in pending.items():
+            online = [user_id for user_id, status in changes.items() if status == ONLINE]
+            offline = [user_id for user_id, status in changes.items() if status == OFFLINE]
+            await self.manager.broadcast(Packet.build(PRESENCE, room=room, online=online, offline=offline), room)
+            self.frames += 1
+        for room, changes in typing_pending.items():
+            typing = [user_id for user_id, state in changes.items() if state]
+            stopped = [user_id for user_id, state in changes.items() if not state]
+            # deltas, so no coalescing key: a queued frame must not be replaced
+            await self.manager.broadcast(Packet.build(TYPING, room=room, typing=typing, stopped=stopped), room)
+            self.frames += 1
+
+    def stats(self) -> dict:
+        return {
+            'pending_rooms': len(self.pending) + len(self.typing_pending),
+            'typing': sum(len(typists) for typists in self.typists.values()),
+            'frames': self.frames,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+        }
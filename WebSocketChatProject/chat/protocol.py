@@ -0,0 +1,186 @@
+from typing import Dict, Optional, Tuple
+
+import orjson
+from fastapi import WebSocket
+
+from .broker import Frame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+VERSION = 1
+
+# envelope types; clients send message, typing, ack, join and leave, the
+# server also sends presence, file, sync, joined, left, members and error.
+# message and file carry the room's seq; sync tells a resuming client to
+# reload history instead; members lists who was added to or removed from a
+# group room. Either side may send ping, answered with pong
+MESSAGE = 'message'
+TYPING = 'typing'
+ACK = 'ack'
+JOIN = 'join'
+LEAVE = 'leave'
+PRESENCE = 'presence'
+FILE = 'file'
+SYNC = 'sync'
+JOINED = 'joined'
+LEFT = 'left'
+MEMBERS = 'members'
+ERROR = 'error'
+PING = 'ping'
+PONG = 'pong'
+CLIENT_TYPES = (MESSAGE, TYPING, ACK, JOIN, LEAVE, PING, PONG)
+# envelopes that don't belong to a room
+ROOMLESS_TYPES = (PING, PONG)
+
+# browsers can't set headers on a WebSocket, so the JWT may come as an
+# extra offered subprotocol: "access_token.<jwt>"
+TOKEN_SUBPROTOCOL_PREFIX = 'access_token.'
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def check_envelope(packet) -> dict:
+    if not isinstance(packet, dict):
+        raise ProtocolError('Envelope must be an object')
+    if packet.get('v', VERSION) != VERSION:
+        raise ProtocolError(f'Unsupported protocol version, expected {VERSION}')
+    if packet.get('type') not in CLIENT_TYPES:
+        raise ProtocolError('Unknown envelope type')
+    return packet
+
+
+class Codec:
+    name = ''
+    # Sec-WebSocket-Protocol value that selects this codec
+    subprotocol: Optional[str] = None
+
+    def encode(self, packet: dict) -> Optional[Frame]:
+        """Frame for ``packet``, or None when this codec has no way to show it."""
+        raise NotImplementedError
+
+    def decode(self, frame: Frame) -> dict:
+        raise NotImplementedError
+
+
+class TextCodec(Codec):
+    """Pre-envelope clients: plain text in, message bodies out, nothing else."""
+
+    name = 'text'
+
+    def encode(self, packet: dict) -> Optional[Frame]:
+        if packet['type'] == MESSAGE:
+            return packet['body']
+        return None
+
+    def decode(self, frame: Frame) -> dict:
+        if not isinstance(frame, str):
+            raise ProtocolError('Text frames only')
+        return {'v': VERSION, 'type': MESSAGE, 'body': frame}
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    subprotocol = 'chat.v1.json'
+
+    def encode(self, packet: dict) -> Optional[Frame]:
+        return orjson.dumps(packet).decode()
+
+    def decode(self, frame: Frame) -> dict:
+        try:
+            return check_envelope(orjson.loads(frame))
+        except orjson.JSONDecodeError:
+            raise ProtocolError('Invalid JSON')
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    subprotocol = 'chat.v1.msgpack'
+
+    def encode(self, packet: dict) -> Optional[Frame]:
+        return msgpack.packb(packet, use_bin_type=True)
+
+    def decode(self, frame: Frame) -> dict:
+        if not isinstance(frame, bytes):
+            raise ProtocolError('Binary frames only')
+        try:
+            return check_envelope(msgpack.unpackb(frame, raw=False))
+        except (ValueError, TypeError):
+            raise ProtocolError('Invalid msgpack')
+
+
+TEXT = TextCodec()
+JSON = JsonCodec()
+CODECS: Dict[str, Codec] = {TEXT.name: TEXT, JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+SUBPROTOCOLS = {codec.subprotocol: codec for codec in CODECS.values() if codec.subprotocol}
+
+
+def negotiate(websocket: WebSocket, default: Codec = TEXT) -> Tuple[Codec, Optional[str]]:
+    """Pick the codec from the offered subprotocols or ``?encoding=``.
+
+    Returns the codec and the subprotocol to accept with. Clients that ask
+    for neither get ``default``, plain text on the room socket. Compression
+    is not negotiated here: uvicorn offers permessage-deflate on every
+    socket.
+    """
+    offered = websocket.scope.get('subprotocols') or ()
+    for subprotocol in offered:
+        codec = SUBPROTOCOLS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    codec = CODECS.get(websocket.query_params.get('encoding', ''), default)
+    # a browser that offered only its token fails the handshake unless
+    # one offered subprotocol is accepted
+    for subprotocol in offered:
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return codec, subprotocol
+    return codec, None
+
+
+def handshake_token(websocket: WebSocket) -> Optional[str]:
+    """The JWT from ``?token=`` or from an ``access_token.<jwt>`` subprotocol."""
+    token = websocket.query_params.get('token')
+    if token:
+        return token
+    for subprotocol in websocket.scope.get('subprotocols') or ():
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    return None
+
+
+class Packet:
+    """One outgoing envelope, encoded at most once per codec.
+
+    A broadcast builds a single Packet and every recipient takes the frame
+    for its codec from ``frames``, so a room of 500 JSON sockets costs one
+    ``orjson.dumps``, not 500.
+    """
+
+    __slots__ = ('fields', 'frames')
+
+    def __init__(self, fields: dict, frames: Optional[Dict[str, Optional[Frame]]] = None):
+        self.fields = fields
+        self.frames = frames if frames is not None else {}
+
+    @classmethod
+    def build(cls, kind: str, **fields) -> 'Packet':
+        return cls({'v': VERSION, 'type': kind, **fields})
+
+    @classmethod
+    def from_json(cls, frame: str) -> 'Packet':
+        # relayed by the broker already encoded; JSON sockets reuse it as is
+        return cls(orjson.loads(frame), {JSON.name: frame})
+
+    def frame(self, codec: Codec) -> Optional[Frame]:
+        frames = self.frames
+        try:
+            return frames[codec.name]
+        except KeyError:
+            frame = frames[codec.name] = codec.encode(self.fields)
+            return frame
@@ -0,0 +1,78 @@
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+from .protocol import Packet
+
+
+class ReplayBuffer:
+    """The last ``per_room`` sequenced packets of recently active rooms.
+
+    Packets keep their encoded frames, so replaying a gap to a reconnecting
+    client costs no serialization. Rooms are evicted least recently used
+    beyond ``max_rooms``.
+    """
+
+    def __init__(self, per_room: int = 256, max_rooms: int = 10000):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.rooms: 'OrderedDict[str, Deque[Tuple[int, Packet]]]' = OrderedDict()
+        self.replayed = 0
+        self.misses = 0
+
+    def add(self, room: str, packet: Packet):
+        seq = packet.fields['seq']
+        buffer = self.rooms.get(room)
+        if buffer is None:
+            buffer = self.rooms[room] = deque(maxlen=self.per_room)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        if not buffer or buffer[-1][0] < seq:
+            buffer.append((seq, packet))
+            return
+        # publishes from other workers can overtake each other on the way
+        for index in range(len(buffer) - 1, -1, -1):
+            if buffer[index][0] == seq:
+                return
+            if buffer[index][0] < seq:
+                if len(buffer) == buffer.maxlen:
+                    buffer.popleft()
+                    index -= 1
+                buffer.insert(index + 1, (seq, packet))
+                break
+        else:
+            if len(buffer) < buffer.maxlen:
+                buffer.appendleft((seq, packet))
+
+    def since(self, room: str, last_seq: int, limit: int) -> Optional[List[Packet]]:
+        """Every buffered packet after ``last_seq`` in seq order, gaps and all,
+        or None when there are more than ``limit`` of them."""
+        missed = [packet for seq, packet in self.rooms.get(room, ()) if seq > last_seq]
+        if len(missed) > limit:
+            self.misses += 1
+            return None
+        self.replayed += len(missed)
+        return missed
+
+    def covers(self, room: str, last_seq: int, current_seq: int) -> bool:
+        """Whether the buffer holds every packet after ``last_seq`` up to ``current_seq``."""
+        expected = last_seq + 1
+        for seq, _ in self.rooms.get(room, ()):
+            if seq < expected:
+                continue
+            if seq != expected:
+                break
+            expected += 1
+        if expected <= current_seq:
+            self.misses += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'rooms': len(self.rooms),
+            'packets': sum(len(buffer) for buffer in self.rooms.values()),
+            'replayed': self.replayed,
+            'misses': self.misses,
+        }
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, case, func, insert, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.models import Message, Room, RoomMember
+
+logger = logging.getLogger(__name__)
+
+SAVED_COLUMNS = (
+    Message.id,
+    Message.sender_id,
+    Message.receiver_id,
+    Message.room_id,
+    Message.attachment_id,
+    Message.message,
+    Message.created_at,
+)
+
+
+PREVIEW_LENGTH = 200
+
+rooms = Room.__table__
+members = RoomMember.__table__
+_is_newer = func.coalesce(rooms.c.last_message_id, 0) < bindparam('b_last_id')
+
+# one executemany per batch; rows are only touched when the batch has
+# something newer than what the room already shows
+ROOM_ACTIVITY = update(rooms).where(rooms.c.id == bindparam('b_room_id')).values(
+    message_count=rooms.c.message_count + bindparam('b_count'),
+    last_message_id=case((_is_newer, bindparam('b_last_id')), else_=rooms.c.last_message_id),
+    last_message_preview=case((_is_newer, bindparam('b_preview')), else_=rooms.c.last_message_preview),
+    last_sender_id=case((_is_newer, bindparam('b_sender_id')), else_=rooms.c.last_sender_id),
+    last_activity_at=case((_is_newer, bindparam('b_created_at')), else_=rooms.c.last_activity_at),
+)
+
+# authors have read their own messages
+ROOM_READ = update(rooms).where(rooms.c.id == bindparam('b_room_id')).values(
+    sender_read_count=case(
+        (rooms.c.sender_id == bindparam('b_author_id'), rooms.c.sender_read_count + bindparam('b_count')),
+        else_=rooms.c.sender_read_count,
+    ),
+    receiver_read_count=case(
+        (rooms.c.receiver_id == bindparam('b_author_id'), rooms.c.receiver_read_count + bindparam('b_count')),
+        else_=rooms.c.receiver_read_count,
+    ),
+)
+
+# group messages have no receiver; their authors' counts are in room_member
+MEMBER_READ = update(members).where(
+    members.c.room_id == bindparam('b_room_id'), members.c.user_id == bindparam('b_author_id')
+).values(read_count=members.c.read_count + bindparam('b_count'))
+
+
+async def update_room_counters(session: AsyncSession, saved: List[dict]):
+    """Fold freshly saved messages into the inbox columns of their rooms."""
+    activity: Dict[int, dict] = {}
+    read: Dict[Tuple[int, int], int] = {}
+    group_read: Dict[Tuple[int, int], int] = {}
+    for message in saved:
+        room_id = message['room_id']
+        if room_id is None:
+            continue
+        entry = activity.get(room_id)
+        if entry is None:
+            entry = activity[room_id] = {'b_room_id': room_id, 'b_count': 0, 'b_last_id': 0}
+        entry['b_count'] += 1
+        if message['id'] > entry['b_last_id']:
+            entry['b_last_id'] = message['id']
+            entry['b_preview'] = (message['message'] or '')[:PREVIEW_LENGTH]
+            entry['b_sender_id'] = message['sender_id']
+            entry['b_created_at'] = message['created_at']
+        counts = read if message['receiver_id'] is not None else group_read
+        pair = (room_id, message['sender_id'])
+        counts[pair] = counts.get(pair, 0) + 1
+    if not activity:
+        return
+    # same lock order in every transaction, so concurrent batches can't deadlock
+    await session.execute(ROOM_ACTIVITY, [activity[room_id] for room_id in sorted(activity)])
+    for statement, counts in ((ROOM_READ, read), (MEMBER_READ, group_read)):
+        if counts:
+            await session.execute(statement, [
+                {'b_room_id': room_id, 'b_author_id': author_id, 'b_count': count}
+                for (room_id, author_id), count in sorted(counts.items())
+            ])
+
+
+async def save_messages(session: AsyncSession, rows: List[dict]) -> List[dict]:
+    """Insert ``rows`` with a single multi-row INSERT and return them as saved."""
+    result = await session.execute(insert(Message).values(rows).returning(*SAVED_COLUMNS))
+    saved = [dict(row._mapping) for row in result]
+    await update_room_counters(session, saved)
+    return saved
+
+
+class MessageWriter:
+    """Write-behind buffer between the socket loop and the ``message`` table.
+
+    ``put`` only appends to an in-memory list; a background task turns the
+    buffer into one multi-row INSERT as soon as ``batch_size`` rows are
+    waiting or ``flush_interval`` seconds after the first row arrived.
+    Whatever is still buffered is flushed on ``stop``. ``on_saved`` gets
+    every committed batch, ids included.
+
+    A batch the database rejects because of its rows (a foreign key, a
+    value Postgres can't store) is split in halves until the offending row
+    is alone; that row is dead-lettered and logged, the rest is written.
+    Any other failure keeps the batch for the next flush.
+    """
+
+    def __init__(
+            self,
+            session_maker,
+            batch_size: int = 500,
+            flush_interval: float = 0.05,
+            max_pending: int = 50000,
+            on_saved: Optional[Callable[[List[dict]], None]] = None,
+            dead_letter_size: int = 1000
+    ):
+        self.session_maker = session_maker
+        self.on_saved = on_saved
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: List[dict] = []
+        self.written = 0
+        self.rejected = 0
+        self.failures = 0
+        # rows that could not be written, newest last
+        self.dead_letters: Deque[dict] = deque(maxlen=dead_letter_size)
+        self.dead_lettered = 0
+        self.flushes = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._queued: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        self._queued = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # let a flush that is already running finish instead of cancelling
+        # it halfway through a commit
+        self._stopping = True
+        if self._task is not None:
+            self._queued.set()
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self.pending:
+            logger.error('Shutting down with %d unsaved messages', len(self.pending))
+
+    def put(self, sender_id: int, receiver_id: Optional[int], message: str, room_id: Optional[int] = None) -> bool:
+        pending = self.pending
+        if len(pending) >= self.max_pending:
+            self.rejected += 1
+            return False
+        pending.append({
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'room_id': room_id,
+            'message': message,
+        })
+        if self._queued is not None:
+            self._queued.set()
+            if len(pending) >= self.batch_size:
+                self._full.set()
+        return True
+
+    async def _run(self):
+        while not self._stopping:
+            await self._queued.wait()
+            if len(self.pending) < self.batch_size and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._queued.clear()
+            self._full.clear()
+            if self._stopping:
+                return
+            if not await self.flush():
+                await asyncio.sleep(1)
+            if self.pending:
+                self._queued.set()
+
+    async def flush(self) -> bool:
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            # parts still to write, the next one last
+            parts = [batch]
+            while parts:
+                part = parts.pop()
+                started = time.perf_counter()
+                try:
+                    async with self.session_maker() as session:
+                        saved = await save_messages(session, part)
+                        await session.commit()
+                except (DataError, IntegrityError) as e:
+                    self.failures += 1
+                    if len(part) == 1:
+                        self._dead_letter(part[0], e)
+                    else:
+                        half = len(part) // 2
+                        parts.append(part[half:])
+                        parts.append(part[:half])
+                    continue
+                except Exception:
+                    # keep the unwritten rows, in order, for the next flush
+                    self.pending[:0] = part + [row for rest in reversed(parts) for row in rest]
+                    self.failures += 1
+                    logger.exception('Failed to write %d messages', len(part))
+                    return False
+                latency = time.perf_counter() - started
+                self.flushes += 1
+                self.written += len(part)
+                self.last_batch_size = len(part)
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                if self.on_saved is not None:
+                    self.on_saved(saved)
+        return True
+
+    def _dead_letter(self, row: dict, error: Exception):
+        self.dead_letters.append(row)
+        self.dead_lettered += 1
+        logger.error(
+            'Dropping message from user %s to room %s, the database rejected it: %s',
+            row['sender_id'], row['room_id'], getattr(error, 'orig', error),
+        )
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self.pending),
+            'written': self.written,
+            'rejected': self.rejected,
+            'failures': self.failures,
+            'dead_lettered': self.dead_lettered,
+            'flushes': self.flushes,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
@@ -1,6 +1,6 @@
 import os
 import secrets
-from typing import List
+from typing import List, Optional
 
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
@@ -40,6 +40,18 @@ class Settings(BaseSettings):
     DB_USER: str = os.getenv('DB_USER')
     DB_PASSWORD: str = os.getenv('DB_PASSWORD')
     DB_NAME: str = os.getenv('DB_NAME')
+    # full url overrides the DB_* parts above, e.g. sqlite+aiosqlite:///bench.db
+    DATABASE_URL: Optional[str] = os.getenv('DATABASE_URL')
+    DB_REPLICA_URL: Optional[str] = os.getenv('DB_REPLICA_URL')
+
+    # connection pool, sized against the Postgres max_connections of all workers
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_WARM_UP_CONNECTIONS: int = 2
 
     # DATABASE_URI = f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}'
     # SQLALCHEMY_DATABASE_URI: str = f'mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
@@ -52,6 +64,97 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 12
     FORGET_PASSWORD_LINK_EXPIRE_MINUTES: int = 10
     SECRET_KEY: str = os.getenv('SECRET')
+    # decoded JWT payloads kept in memory until they expire
+    TOKEN_CACHE_SIZE: int = 10000
+    # revoked token ids shared by all workers, e.g. redis://redis:6379/2; per process when unset
+    TOKEN_REVOCATION_STORE_URL: Optional[str] = os.getenv('TOKEN_REVOCATION_STORE_URL')
+
+    # bcrypt runs in a thread pool; callers beyond MAX_PENDING get 503
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_CONCURRENCY: int = 4
+    PASSWORD_HASH_MAX_PENDING: int = 64
+
+    # Google OAuth; the discovery url can point at a local mock server
+    GOOGLE_DISCOVERY_URL: str = 'https://accounts.google.com/.well-known/openid-configuration'
+    GOOGLE_HTTP_TIMEOUT: float = 10.0
+    GOOGLE_HTTP_RETRIES: int = 2
 
     APP_HOST: str = 'http://localhost:8000'
     FORGET_PASSWORD_URL: str = 'reset-password'
+
+    # WebSocket connection limits (per worker process)
+    WS_MAX_CONNECTIONS: int = 10000
+    WS_MAX_ROOM_CONNECTIONS: int = 500
+    # group rooms are meant to be big, they get their own cap
+    WS_MAX_GROUP_CONNECTIONS: int = 5000
+    GROUP_MAX_MEMBERS: int = 5000
+    # outbound frames buffered per socket; drop_oldest, coalesce or disconnect when full
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_OVERFLOW_POLICY: str = 'drop_oldest'
+    # pub/sub backplane shared by all workers, e.g. redis://redis:6379/0; in-process when unset
+    BROKER_URL: Optional[str] = os.getenv('BROKER_URL')
+    # sequenced packets kept per room for clients that reconnect with ?last_seq=
+    WS_REPLAY_BUFFER_SIZE: int = 256
+    WS_REPLAY_ROOMS: int = 10000
+    # last acked seq per (user, room), used when a client reconnects without one
+    WS_RESUME_POINTS: int = 100000
+    # envelope sockets quiet for WS_PING_INTERVAL get a ping and are closed after
+    # WS_IDLE_TIMEOUT without any frame; any socket whose writer is stuck for
+    # WS_SEND_TIMEOUT is closed too. The reaper checks every WS_REAP_INTERVAL
+    WS_PING_INTERVAL: float = 25.0
+    WS_IDLE_TIMEOUT: float = 75.0
+    WS_SEND_TIMEOUT: float = 30.0
+    WS_REAP_INTERVAL: float = 5.0
+
+    # /metrics lists connection counts for this many of the largest rooms
+    METRICS_TOP_ROOMS: int = 20
+
+    # token buckets, "<count>/<second|minute|hour|day>"; the count is also the burst
+    RATE_LIMIT_SEND_MESSAGE: str = '20/second'
+    RATE_LIMIT_LOGIN: str = '10/minute'
+    RATE_LIMIT_FORGET_PASSWORD: str = '5/hour'
+    # frames per user, over all of their sockets; a socket that keeps
+    # sending while throttled is closed
+    RATE_LIMIT_WS_FRAMES: str = '30/second'
+    # WebSocket handshakes per client address
+    RATE_LIMIT_WS_CONNECT: str = '60/minute'
+    # buckets shared by all workers, e.g. redis://redis:6379/1; per process when unset
+    RATE_LIMIT_STORE_URL: Optional[str] = os.getenv('RATE_LIMIT_STORE_URL')
+    # presence and typing changes are batched per room over this window
+    PRESENCE_WINDOW: float = 0.25
+    TYPING_TTL: float = 6.0
+
+    # write-behind queue for messages received over the socket
+    MESSAGE_BATCH_SIZE: int = 500
+    MESSAGE_FLUSH_INTERVAL: float = 0.05
+    MESSAGE_MAX_PENDING: int = 50000
+
+    # message is partitioned by month (UTC): partitions are created
+    # MESSAGE_PARTITIONS_AHEAD months ahead, detached once older than
+    # MESSAGE_RETENTION_MONTHS (0 keeps everything) and then written to
+    # MESSAGE_ARCHIVE_DIR as gzipped ndjson or parquet (needs pyarrow) and dropped
+    MESSAGE_PARTITIONS_AHEAD: int = 3
+    MESSAGE_RETENTION_MONTHS: int = 0
+    MESSAGE_ARCHIVE_DIR: str = 'media/archive'
+    MESSAGE_ARCHIVE_FORMAT: str = 'ndjson'
+    MESSAGE_ARCHIVE_BATCH_SIZE: int = 5000
+    PARTITION_MAINTENANCE_INTERVAL: float = 3600
+    # DDL gives up instead of queueing writers behind it, and is retried next run
+    PARTITION_LOCK_TIMEOUT: float = 5
+    # history pages read the last days first, so they only touch recent partitions
+    MESSAGE_HOT_WINDOW_DAYS: int = 45
+
+    # newest messages of recently opened conversations, served without a query
+    HISTORY_CACHE_CONVERSATIONS: int = 10000
+    HISTORY_CACHE_MESSAGES: int = 50
+    HISTORY_CACHE_TTL: float = 300
+    # with a shared broker the other workers' saves never reach this
+    # process's cache, so entries only live this long there
+    HISTORY_CACHE_SHARED_TTL: float = 2.0
+    HISTORY_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    ROOM_CACHE_SIZE: int = 100000
+
+    # attachments are streamed to this directory in chunks, never held in memory whole
+    FILE_STORAGE_DIR: str = 'media/attachments'
+    FILE_CHUNK_SIZE: int = 64 * 1024
+    FILE_MAX_SIZE: int = 100 * 1024 * 1024
@@ -1,26 +1,112 @@
 import base64
+import binascii
 import hashlib
+import heapq
 import json
-from typing import List
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Set, Tuple
 
-from fastapi import FastAPI, WebSocket, APIRouter, Depends, HTTPException
+import jwt
+from fastapi import FastAPI, WebSocket, APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.exc import NoResultFound
 from starlette.websockets import WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import insert, select
+from sqlalchemy import (
+    Integer, and_, case, cast, delete, func, insert, literal, null, or_, select, true, tuple_, union_all, update,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from starlette import status
+
+from auth.schemas import UserPageScheme
+from models.models import Attachment, Message, UserData, Room, RoomMember, SEARCH_CONFIG
+from schemes import (
+    MessageScheme, RoomScheme, ReceiverScheme, MessagePageScheme, InboxPageScheme, MessageSearchPageScheme,
+    GroupCreateScheme, GroupScheme, GroupMembersScheme, GroupMemberPageScheme,
+)
+from auth.utils import verify_token, decode_token, verifier
+from database import engine, get_async_session, get_read_session, async_session_maker, warm_up, dispose, pool_stats
+from auth.auth import register_router, password_hasher, google_client
+from chat.broker import MemoryBroker, make_broker
+from chat.manager import Connection, WebSocketManager
+from chat.presence import PresenceService
+from chat.protocol import (
+    ACK, ERROR, FILE, JOIN, JOINED, JSON, LEAVE, LEFT, MESSAGE, PING, PONG, ROOMLESS_TYPES, TYPING,
+    Packet, ProtocolError, handshake_token, negotiate,
+)
+from chat.files import FileStore, FileTooLarge
+from chat.cache import HistoryCache, RoomCache, conversation_key, room_key
+from chat.writer import MessageWriter, SAVED_COLUMNS, save_messages
+from config import Settings
+from partitions import PartitionMaintainer
+from metrics import (
+    CONTENT_TYPE, REGISTRY, SIZE_BUCKETS, Counter, Gauge, Histogram, MetricsMiddleware,
+)
+from ratelimit import Limit, RateLimitMiddleware, RateLimiter, WS_CLOSE_RATE_LIMITED, client_ip, make_store
+
+settings = Settings()
+
 
-from auth.schemas import UserRead
-from models.models import Message, UserData, Room
-from schemes import MessageScheme, RoomScheme, ReceiverScheme, MessageShowScheme
-from auth.utils import verify_token
-from database import get_async_session
-from auth.auth import register_router
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_up()
+    await verifier.revoked.start()
+    await manager.start()
+    await presence.start()
+    await message_writer.start()
+    await partition_maintainer.start()
+    yield
+    await partition_maintainer.stop()
+    await presence.stop()
+    await manager.stop()
+    await message_writer.stop()
+    await rate_limiter.close()
+    await verifier.revoked.stop()
+    password_hasher.shutdown()
+    await google_client.close()
+    await dispose()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 router = APIRouter()
 app.mount("/static", StaticFiles(directory="Frontend/static"), name="static")
+
+
+def user_or_ip(scope) -> str:
+    """The bearer token's user, or the client address for anonymous calls."""
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            scheme, _, token = value.decode('latin-1').partition(' ')
+            if scheme.lower() == 'bearer':
+                try:
+                    return f'user:{decode_token(token).get("user_id")}'
+                except jwt.InvalidTokenError:
+                    pass
+            break
+    return client_ip(scope)
+
+
+ws_frame_limit = Limit.parse(settings.RATE_LIMIT_WS_FRAMES)
+rate_limiter = RateLimiter(make_store(settings.RATE_LIMIT_STORE_URL), {
+    'send_message': Limit.parse(settings.RATE_LIMIT_SEND_MESSAGE),
+    'login': Limit.parse(settings.RATE_LIMIT_LOGIN),
+    'forget_password': Limit.parse(settings.RATE_LIMIT_FORGET_PASSWORD),
+    'ws_frames': ws_frame_limit,
+    'ws_connect': Limit.parse(settings.RATE_LIMIT_WS_CONNECT),
+})
+# innermost: sees the matched route, not requests rejected further out
+app.add_middleware(MetricsMiddleware)
+# added before CORS so that 429 responses still carry CORS headers
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter, rules={
+    ('POST', '/send-message'): ('send_message', user_or_ip),
+    ('POST', '/login'): ('login', client_ip),
+    ('POST', '/forget-password'): ('forget_password', client_ip),
+}, websocket_rule=('ws_connect', client_ip))
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # can alter with time
@@ -30,51 +116,533 @@ app.add_middleware(
 )
 
 
-class WebSocketManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        # self.encryption_key = Fernet(encryption_key.encode())
+manager = WebSocketManager(
+    max_connections=settings.WS_MAX_CONNECTIONS,
+    max_room_connections=settings.WS_MAX_ROOM_CONNECTIONS,
+    send_queue_size=settings.WS_SEND_QUEUE_SIZE,
+    overflow=settings.WS_OVERFLOW_POLICY,
+    broker=make_broker(settings.BROKER_URL),
+    replay_size=settings.WS_REPLAY_BUFFER_SIZE,
+    replay_rooms=settings.WS_REPLAY_ROOMS,
+    resume_points=settings.WS_RESUME_POINTS,
+    ping_interval=settings.WS_PING_INTERVAL,
+    idle_timeout=settings.WS_IDLE_TIMEOUT,
+    send_timeout=settings.WS_SEND_TIMEOUT,
+    reap_interval=settings.WS_REAP_INTERVAL,
+)
+presence = PresenceService(manager, window=settings.PRESENCE_WINDOW, typing_ttl=settings.TYPING_TTL)
+manager.on_leave = presence.left
+history_cache = HistoryCache(
+    max_conversations=settings.HISTORY_CACHE_CONVERSATIONS,
+    per_conversation=settings.HISTORY_CACHE_MESSAGES,
+    ttl=settings.HISTORY_CACHE_TTL if isinstance(manager.broker, MemoryBroker) else min(
+        settings.HISTORY_CACHE_TTL, settings.HISTORY_CACHE_SHARED_TTL,
+    ),
+    max_bytes=settings.HISTORY_CACHE_MAX_BYTES,
+)
+room_cache = RoomCache(settings.ROOM_CACHE_SIZE)
+file_store = FileStore(settings.FILE_STORAGE_DIR, settings.FILE_CHUNK_SIZE, settings.FILE_MAX_SIZE)
+message_writer = MessageWriter(
+    async_session_maker,
+    batch_size=settings.MESSAGE_BATCH_SIZE,
+    flush_interval=settings.MESSAGE_FLUSH_INTERVAL,
+    max_pending=settings.MESSAGE_MAX_PENDING,
+    on_saved=history_cache.append,
+)
+partition_maintainer = PartitionMaintainer(
+    engine,
+    months_ahead=settings.MESSAGE_PARTITIONS_AHEAD,
+    retention_months=settings.MESSAGE_RETENTION_MONTHS,
+    archive_dir=settings.MESSAGE_ARCHIVE_DIR,
+    archive_format=settings.MESSAGE_ARCHIVE_FORMAT,
+    batch_size=settings.MESSAGE_ARCHIVE_BATCH_SIZE,
+    interval=settings.PARTITION_MAINTENANCE_INTERVAL,
+    lock_timeout=settings.PARTITION_LOCK_TIMEOUT,
+)
 
-    async def connect(self, websocket: WebSocket, room: str):
-        if len(self.active_connections) < 2:
-            await websocket.accept()
-            self.active_connections.append({"socket": websocket, "room": room})
 
-    async def disconnect(self, websocket: WebSocket):
-        for connection in self.active_connections:
-            if connection['socket'] == websocket:
-                self.active_connections.remove(connection)
-                break
+async def get_room_peer(key: str, user_id: int) -> Tuple[Optional[int], Optional[int]]:
+    """Room id and the other user of ``key``; the peer is None in group rooms."""
+    room = room_cache.get_key(key)
+    if room is None:
+        async with async_session_maker() as session:
+            query = select(Room.id, Room.key, Room.sender_id, Room.receiver_id, Room.is_group).where(Room.key == key)
+            row = (await session.execute(query)).first()
+        if row is None or (not row.is_group and (row.sender_id is None or row.receiver_id is None)):
+            return None, None
+        room = dict(row._mapping)
+        room_cache.put(room)
+    if room.get('is_group'):
+        return (room['id'], None) if await is_member(key, room['id'], user_id) else (None, None)
+    if user_id not in (room['sender_id'], room['receiver_id']):
+        return None, None
+    return room['id'], room['receiver_id'] if room['sender_id'] == user_id else room['sender_id']
 
-    async def broadcast(self, message:str, room: str):
-        for connection in self.active_connections:
-            if connection['room'] == room:
-                await connection["socket"].send_text(message)
 
-    async def send_to_all(self, data: str):
-        for connection in self.active_connections:
-            await connection['socket'].send_text(data)
+async def is_member(key: str, room_id: int, user_id: int) -> bool:
+    # rooms with local sockets have their members in memory
+    members = manager.members.get(key)
+    if members is not None:
+        return user_id in members
+    async with async_session_maker() as session:
+        query = select(RoomMember.user_id).where(RoomMember.room_id == room_id, RoomMember.user_id == user_id)
+        return (await session.execute(query)).first() is not None
 
 
-manager = WebSocketManager()
+async def load_members(room_id: int) -> Set[int]:
+    async with async_session_maker() as session:
+        result = await session.execute(select(RoomMember.user_id).where(RoomMember.room_id == room_id))
+        return set(result.scalars())
 
 
-@router.websocket('/ws/{room}')
-async def websocket_endpoint(websocket: WebSocket, room: str):
-    await manager.connect(websocket, room)
+def authenticate(websocket: WebSocket) -> Optional[dict]:
+    """Claims of the handshake token, checked once for the socket's lifetime."""
+    token = handshake_token(websocket)
+    if token is None:
+        return None
+    try:
+        return decode_token(token)
+    except jwt.InvalidTokenError:
+        return None
+
+
+async def enter_room(connection: Connection, room: str, last_seq: Optional[int] = None, resume: bool = False) -> bool:
+    user_id = connection.user_id
+    if room in connection.rooms:
+        # a repeated join: the socket is counted once in presence and has
+        # had its snapshot, everything since reached it live
+        return True
+    if room not in connection.allowed:
+        room_id, receiver_id = await get_room_peer(room, user_id)
+        if room_id is None:
+            return False
+        connection.allowed[room] = (room_id, receiver_id)
+    room_id, receiver_id = connection.allowed[room]
+    members = max_connections = None
+    if receiver_id is None:
+        # group room: the whole membership is read once per worker, when its
+        # first socket comes in; later joins are checked in memory. Checked
+        # on every entry, the cached check may predate a removal
+        members = manager.members.get(room)
+        if members is None:
+            members = await load_members(room_id)
+        if user_id not in members:
+            connection.allowed.pop(room, None)
+            return False
+        max_connections = settings.WS_MAX_GROUP_CONNECTIONS
+    if not await manager.enter(connection, room, last_seq, resume, members, max_connections):
+        return False
+    await presence.joined(room, user_id)
+    snapshot = (await presence.snapshot(room)).frame(connection.codec)
+    if snapshot is not None:
+        connection.enqueue(snapshot)
+    return True
+
+
+async def leave_room(connection: Connection, room: str):
+    manager.leave(connection, room)
+    await presence.left(room, connection.user_id)
+
+
+async def serve(connection: Connection, default_room: Optional[str] = None):
+    """Read envelopes until the socket closes.
+
+    Envelopes name their room, or fall back to ``default_room`` on the
+    single-room socket. Only rooms the connection has entered are
+    accepted; membership was checked against ``Room`` once, on entry.
+    """
+    websocket = connection.websocket
+    codec = connection.codec
+    user_id = connection.user_id
+    # one budget per user in the shared store: more sockets don't buy more frames
+    frame_key = f'user:{user_id}'
+    # frames rejected since the last accepted one
+    strikes = 0
     try:
         while True:
-            data = await websocket.receive_text()
-            await manager.broadcast(data, room)
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                break
+            connection.seen()
+            wait = await rate_limiter.hit('ws_frames', frame_key)
+            if wait > 0:
+                strikes += 1
+                if strikes >= ws_frame_limit.capacity:
+                    # a whole burst sent past the error frames
+                    await manager.disconnect(connection, code=WS_CLOSE_RATE_LIMITED)
+                    break
+                error = Packet.build(ERROR, detail='Too many frames', retry_after=round(wait, 3)).frame(codec)
+                if error is not None:
+                    connection.enqueue(error)
+                continue
+            strikes = 0
+            if connection.expires is not None and time.time() >= connection.expires:
+                await manager.disconnect(connection, code=status.WS_1008_POLICY_VIOLATION)
+                break
+            data = frame.get('text')
+            try:
+                envelope = codec.decode(data if data is not None else frame.get('bytes'))
+                kind = envelope['type']
+                if kind in ROOMLESS_TYPES:
+                    # a pong only needs to have been received
+                    if kind == PING:
+                        connection.enqueue(Packet.build(PONG, ts=envelope.get('ts')).frame(codec))
+                    continue
+                room = envelope.get('room') or default_room
+                if not isinstance(room, str):
+                    raise ProtocolError('Room is required')
+                if kind == MESSAGE and not isinstance(envelope.get('body'), str):
+                    raise ProtocolError('Message body must be a string')
+                if kind == MESSAGE and '\x00' in envelope['body']:
+                    # Postgres text can't store it, the row would never be saved
+                    raise ProtocolError('Message body must not contain NUL characters')
+                if kind == ACK and not isinstance(envelope.get('seq'), int):
+                    raise ProtocolError('Ack seq must be an integer')
+                if kind not in (JOIN, LEAVE) and room not in connection.rooms:
+                    raise ProtocolError('Not in this room')
+            except ProtocolError as e:
+                error = Packet.build(ERROR, detail=f'{e}').frame(codec)
+                if error is not None:
+                    connection.enqueue(error)
+                continue
+            if kind == MESSAGE:
+                body = envelope['body']
+                room_id, receiver_id = connection.allowed[room]
+                # queued for saving first: a message that can't be saved is not delivered either
+                if not message_writer.put(user_id, receiver_id, body, room_id):
+                    error = Packet.build(
+                        ERROR, room=room, client_id=envelope.get('client_id'), detail='Message not saved, try again later',
+                    ).frame(codec)
+                    if error is not None:
+                        connection.enqueue(error)
+                    continue
+                packet = Packet.build(MESSAGE, room=room, sender_id=user_id, body=body)
+                await manager.broadcast(packet, room, sequenced=True)
+                if envelope.get('client_id') is not None:
+                    ack = Packet.build(ACK, client_id=envelope['client_id'], seq=packet.fields['seq'])
+                    connection.enqueue(ack.frame(codec))
+            elif kind == ACK:
+                manager.ack(connection, room, envelope['seq'])
+            elif kind == TYPING:
+                presence.typing(room, user_id, bool(envelope.get('typing', True)))
+            elif kind == JOIN:
+                last_seq = envelope.get('last_seq')
+                if await enter_room(connection, room, last_seq if isinstance(last_seq, int) else None,
+                                    bool(envelope.get('resume'))):
+                    connection.enqueue(Packet.build(JOINED, room=room).frame(codec))
+                else:
+                    connection.enqueue(Packet.build(ERROR, room=room, detail='Cannot join this room').frame(codec))
+            elif kind == LEAVE:
+                if room in connection.rooms:
+                    await leave_room(connection, room)
+                connection.enqueue(Packet.build(LEFT, room=room).frame(codec))
     except WebSocketDisconnect:
-        await manager.disconnect(websocket)
+        pass
+    finally:
+        # presence is released by manager.on_leave, also when the reaper or
+        # a slow-consumer disconnect closed the socket first
+        await manager.disconnect(connection)
+
+
+@router.websocket('/ws')
+async def multiplexed_websocket_endpoint(websocket: WebSocket):
+    """One socket for all of a user's chats.
+
+    Authenticate with ``?token=`` or an ``access_token.<jwt>`` subprotocol,
+    then send ``{"type": "join", "room": key, "last_seq": n}`` per chat and
+    name the room in every envelope. Envelopes are JSON unless msgpack is
+    negotiated.
+    """
+    claims = authenticate(websocket)
+    if claims is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    codec, subprotocol = negotiate(websocket, default=JSON)
+    connection = await manager.connect(websocket, None, claims.get('user_id'), codec, subprotocol)
+    if connection is None:
+        return
+    connection.expires = claims.get('exp')
+    await serve(connection)
+
+
+@router.websocket('/ws/{room}')
+async def websocket_endpoint(
+        websocket: WebSocket,
+        room: str,
+        last_seq: Optional[int] = None,
+        resume: bool = False
+):
+    """Room socket speaking the envelope protocol of ``chat.protocol``.
+
+    The handshake needs a token of one of the room's members (see
+    ``/ws``). Offer ``chat.v1.json`` or ``chat.v1.msgpack`` as subprotocol
+    (or pass ``?encoding=``) to get envelopes; without either, frames are
+    plain message text as before. Reconnect with ``?last_seq=`` to get what
+    was sent in the meantime, or with ``?resume=true`` to continue after
+    the last seq this user acked.
+    """
+    claims = authenticate(websocket)
+    if claims is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_id = claims.get('user_id')
+    room_id, receiver_id = await get_room_peer(room, user_id)
+    if room_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    codec, subprotocol = negotiate(websocket)
+    connection = await manager.connect(websocket, None, user_id, codec, subprotocol)
+    if connection is None:
+        return
+    connection.expires = claims.get('exp')
+    connection.allowed[room] = (room_id, receiver_id)
+    if not await enter_room(connection, room, last_seq, resume):
+        await manager.disconnect(connection, code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    await serve(connection, room)
+
+
+FAN_OUT_SECONDS = Histogram('chat_ws_fan_out_duration_seconds', 'Time to queue one frame for a room.')
+FAN_OUT_RECIPIENTS = Histogram('chat_ws_fan_out_recipients', 'Local sockets per fan-out.', buckets=SIZE_BUCKETS)
+
+
+def record_fan_out(recipients: int, elapsed: float):
+    FAN_OUT_SECONDS.observe(elapsed)
+    FAN_OUT_RECIPIENTS.observe(recipients)
+
+
+manager.on_fan_out = record_fan_out
+Gauge('chat_ws_connections', 'Open WebSocket connections.', collect=lambda: [((), len(manager.connections))])
+Gauge('chat_ws_rooms', 'Rooms with at least one local connection.', collect=lambda: [((), len(manager.rooms))])
+Gauge(
+    'chat_ws_room_connections', 'Connections of the largest rooms.', ('room',),
+    collect=lambda: [
+        ((room,), len(members))
+        for room, members in heapq.nlargest(settings.METRICS_TOP_ROOMS, manager.rooms.items(), key=lambda item: len(item[1]))
+    ],
+)
+Gauge('chat_ws_queued_frames', 'Frames waiting in send queues.', collect=lambda: [((), sum(len(connection.queue) for connection in tuple(manager.connections)))])
+Counter(
+    'chat_ws_reaped_total', 'Connections closed by the reaper.', ('reason',),
+    collect=lambda: [
+        (('idle',), manager.reaped_idle), (('stalled',), manager.reaped_stalled), (('expired',), manager.reaped_expired),
+    ],
+)
+Counter('chat_ws_slow_disconnects_total', 'Connections closed for not keeping up.',
+        collect=lambda: [((), manager.slow_disconnects)])
+Counter('chat_rate_limited_total', 'Calls rejected by a rate limit.', ('rule',),
+        collect=lambda: [((rule,), count) for rule, count in tuple(rate_limiter.throttled.items())])
+Gauge('chat_writer_pending', 'Messages waiting for the write-behind flush.',
+      collect=lambda: [((), len(message_writer.pending))])
+
+
+@router.get('/metrics')
+async def metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@router.get('/ws/stats')
+async def websocket_stats():
+    return {
+        **manager.stats(),
+        'broker': manager.broker.stats(),
+        'presence': presence.stats(),
+        'writer': message_writer.stats(),
+        'history_cache': history_cache.stats(),
+        'room_cache': room_cache.stats(),
+        'files': file_store.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'db_pool': pool_stats(),
+        'partitions': partition_maintainer.stats(),
+    }
+
+
+async def store_attachment(room: str, room_id: int, sender_id: int, receiver_id: Optional[int], stored: dict) -> dict:
+    """Record a file written by ``file_store`` and announce it to the room.
+
+    The file gets an ``attachment`` row and a message pointing at it; the
+    room only receives this small reference, clients fetch the bytes
+    separately.
+    """
+    try:
+        async with async_session_maker() as session:
+            query = insert(Attachment).values(uploader_id=sender_id, room_id=room_id, **stored).returning(Attachment.id)
+            attachment_id = (await session.execute(query)).scalar_one()
+            saved = await save_messages(session, [{
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'room_id': room_id,
+                'attachment_id': attachment_id,
+                'message': stored['filename'],
+            }])
+            await session.commit()
+    except Exception:
+        await file_store.delete(stored['storage_key'])
+        raise
+    history_cache.append(saved)
+    reference = {
+        'id': attachment_id,
+        'message_id': saved[0]['id'],
+        'sender_id': sender_id,
+        'name': stored['filename'],
+        'content_type': stored['content_type'],
+        'size': stored['size'],
+    }
+    await manager.broadcast(Packet.build(FILE, room=room, **reference), room, sequenced=True)
+    return reference
+
+
+def member_rooms(user_id: int):
+    return select(RoomMember.room_id).where(RoomMember.user_id == user_id)
+
+
+async def get_attachment(attachment_id: int, user_id: int) -> Optional[Attachment]:
+    async with async_session_maker() as session:
+        query = select(Attachment).join(Room, Room.id == Attachment.room_id).where(
+            Attachment.id == attachment_id,
+            (Room.sender_id == user_id) | (Room.receiver_id == user_id) | Room.id.in_(member_rooms(user_id)),
+        )
+        return (await session.execute(query)).scalars().first()
 
 
 @router.post('/sendfile')
-async def send_file(file_data: bytes, room: str):
-    base64_data = base64.b64encode(file_data).decode('utf-8')
-    await manager.broadcast(base64_data, room)
-    return {'message': 'File sent'}
+async def send_file(
+        request: Request,
+        room: str,
+        filename: str = 'file',
+        token: dict = Depends(verify_token)
+):
+    """Upload the raw request body as an attachment of ``room``.
+
+    The body is streamed to disk as it arrives instead of being read into
+    memory and base64-encoded.
+    """
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    user_id = token.get('user_id')
+    room_id, receiver_id = await get_room_peer(room, user_id)
+    if room_id is None:
+        raise HTTPException(status_code=404, detail='Room not found')
+    length = request.headers.get('content-length')
+    try:
+        stored = await file_store.save(
+            request.stream(),
+            filename,
+            request.headers.get('content-type'),
+            int(length) if length is not None else None,
+        )
+    except FileTooLarge as e:
+        raise HTTPException(status_code=413, detail=f'{e}')
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'{e}')
+    return await store_attachment(room, room_id, user_id, receiver_id, stored)
+
+
+@router.get('/files/{attachment_id}')
+async def download_file(attachment_id: int, token: dict = Depends(verify_token)):
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    attachment = await get_attachment(attachment_id, token.get('user_id'))
+    if attachment is None:
+        raise HTTPException(status_code=404, detail='File not found')
+    return FileResponse(
+        file_store.path(attachment.storage_key),
+        media_type=attachment.content_type,
+        filename=attachment.filename,
+    )
+
+
+@router.websocket('/ws/{room}/files')
+async def file_transfer_endpoint(websocket: WebSocket, room: str):
+    """Chunked file transfer for ``room``, on its own socket next to the chat.
+
+    Upload: the client sends ``{"type": "offer", "name", "size",
+    "content_type"}``, waits for ``{"type": "accept", "chunk_size"}`` and
+    then sends binary frames of at most ``chunk_size`` bytes until ``size``
+    is reached; it gets ``{"type": "stored", ...}`` back and the room gets
+    the file reference. Download: ``{"type": "get", "id"}`` is answered
+    with ``{"type": "file", ...}``, the content as binary frames and
+    ``{"type": "end"}``. Every send is awaited, so a slow reader slows the
+    transfer down instead of growing a buffer.
+    """
+    claims = authenticate(websocket)
+    room_id = receiver_id = user_id = None
+    if claims is not None:
+        user_id = claims.get('user_id')
+        room_id, receiver_id = await get_room_peer(room, user_id)
+    if room_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept(subprotocol=negotiate(websocket)[1])
+    upload = None
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                break
+            data = frame.get('bytes')
+            if data is not None:
+                if upload is None or len(data) > file_store.chunk_size:
+                    await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+                    break
+                try:
+                    await upload.write(data)
+                except FileTooLarge:
+                    await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+                    break
+                if upload.complete:
+                    stored = await upload.commit()
+                    upload = None
+                    reference = await store_attachment(room, room_id, user_id, receiver_id, stored)
+                    await websocket.send_json({'type': 'stored', **reference})
+                continue
+            try:
+                request = json.loads(frame.get('text') or '')
+                kind = request['type']
+            except (ValueError, TypeError, KeyError):
+                await websocket.send_json({'type': 'error', 'detail': 'Invalid request'})
+                continue
+            if kind == 'offer':
+                if upload is not None:
+                    await websocket.send_json({'type': 'reject', 'detail': 'Upload already in progress'})
+                    continue
+                try:
+                    size = int(request['size'])
+                    if size <= 0:
+                        raise ValueError
+                    upload = await file_store.begin(request.get('name'), request.get('content_type'), size)
+                except FileTooLarge as e:
+                    await websocket.send_json({'type': 'reject', 'detail': f'{e}'})
+                except (ValueError, TypeError, KeyError):
+                    await websocket.send_json({'type': 'reject', 'detail': 'Invalid size'})
+                else:
+                    await websocket.send_json({'type': 'accept', 'chunk_size': file_store.chunk_size})
+            elif kind == 'get':
+                try:
+                    attachment = await get_attachment(int(request['id']), user_id)
+                except (ValueError, TypeError, KeyError):
+                    attachment = None
+                if attachment is None:
+                    await websocket.send_json({'type': 'error', 'detail': 'File not found'})
+                    continue
+                await websocket.send_json({
+                    'type': 'file',
+                    'id': attachment.id,
+                    'name': attachment.filename,
+                    'content_type': attachment.content_type,
+                    'size': attachment.size,
+                })
+                async for chunk in file_store.read(attachment.storage_key):
+                    await websocket.send_bytes(chunk)
+                await websocket.send_json({'type': 'end', 'id': attachment.id})
+            else:
+                await websocket.send_json({'type': 'error', 'detail': 'Unknown request'})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if upload is not None:
+            await upload.abort()
 
 
 @router.post('/send-message')
@@ -90,30 +658,104 @@ async def send_message(
         sender_id = token.get('user_id')
         message_text = message.message
         receiver_id = message.receiver
-        query = insert(Message).values(
-            sender_id=sender_id,
-            message=message_text,
-            receiver_id=receiver_id
-        )
-        await session.execute(query)
+        room = room_cache.get_pair(sender_id, receiver_id)
+        if room is None:
+            room = await upsert_room(session, sender_id, receiver_id)
+            room_cache.put(room)
+        saved = await save_messages(session, [{
+            'sender_id': sender_id,
+            'message': message_text,
+            'receiver_id': receiver_id,
+            'room_id': room['id'],
+        }])
         await session.commit()
     except Exception as e:
         raise HTTPException(status_code=400, detail=f'{e}')
+    history_cache.append(saved)
     return {'success': True}
 
 
-@router.get('/users', response_model=List[UserRead])
+def prefix_pattern(q: str) -> str:
+    escaped = q.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+def user_page(user_id: int, q: Optional[str], after_id: Optional[int], limit: int):
+    """Keyset page of users by id, optionally filtered by a name prefix.
+
+    Each name column has a ``lower(...) text_pattern_ops`` index, so the
+    prefix filter is an index scan per column rather than a full scan.
+    """
+    query = select(UserData.id, UserData.first_name, UserData.last_name, UserData.username).where(
+        UserData.id != user_id
+    )
+    if q:
+        pattern = prefix_pattern(q)
+        query = query.where(or_(
+            func.lower(UserData.username).like(pattern, escape='\\'),
+            func.lower(UserData.first_name).like(pattern, escape='\\'),
+            func.lower(UserData.last_name).like(pattern, escape='\\'),
+        ))
+    if after_id is not None:
+        query = query.where(UserData.id > after_id)
+    return query.order_by(UserData.id).limit(limit)
+
+
+def page_etag(items: List[dict], next_cursor) -> str:
+    digest = hashlib.blake2b(repr((items, next_cursor)).encode(), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+@router.get('/users', response_model=UserPageScheme)
 async def user_list(
+        request: Request,
+        q: Optional[str] = Query(None, max_length=100),
+        after_id: Optional[int] = None,
+        limit: int = Query(50, ge=1, le=200),
         token: dict = Depends(verify_token),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession = Depends(get_read_session)
 ):
     if token is None:
         raise HTTPException(status_code=403, detail='Forbidden')
 
-    query = select(UserData).where(UserData.id != token.get('user_id'))
-    user__data = await session.execute(query)
-    user_data = user__data.scalars().all()
-    return user_data
+    query = user_page(token.get('user_id'), q.strip() if q else None, after_id, limit + 1)
+    items = [dict(row._mapping) for row in await session.execute(query)]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1]['id']
+    # the page is still read, but an unchanged one goes back as a bodyless 304
+    etag = page_etag(items, next_cursor)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return JSONResponse({'items': items, 'next_cursor': next_cursor}, headers=headers)
+
+
+ROOM_COLUMNS = (Room.id, Room.key, Room.sender_id, Room.receiver_id)
+
+
+async def upsert_room(session: AsyncSession, sender_id: int, receiver_id: int) -> dict:
+    """Get or create the room of a user pair in one statement.
+
+    The CTE inserts unless the canonical key already exists, and the union
+    returns either the new row or the existing one.
+    """
+    key = room_key(sender_id, receiver_id)
+    inserted = (
+        pg_insert(Room)
+        .values(key=key, sender_id=sender_id, receiver_id=receiver_id)
+        .on_conflict_do_nothing(index_elements=[Room.key])
+        .returning(*ROOM_COLUMNS)
+        .cte('inserted')
+    )
+    query = union_all(select(inserted), select(*ROOM_COLUMNS).where(Room.key == key)).limit(1)
+    row = (await session.execute(query)).first()
+    await session.commit()
+    if row is None:
+        # a concurrent insert committed after this statement's snapshot
+        row = (await session.execute(select(*ROOM_COLUMNS).where(Room.key == key))).one()
+    return dict(row._mapping)
 
 
 @router.post('/room', response_model=RoomScheme)
@@ -125,63 +767,539 @@ async def get_or_create_room(
     if token is None:
         raise HTTPException(status_code=403, detail='Forbidden')
     sender_id = token.get('user_id')
-    room_data = {
-        "sender_id": sender_id,
-        "receiver_id": receiver.receiver_id
-    }
-    dump_data = json.dumps(room_data)
-    hash_object = hashlib.sha256(dump_data.encode())
-    unique_code = hash_object.hexdigest()
-    query_get = select(Room).where(
-        ((Room.sender_id == sender_id) & (Room.receiver_id == receiver.receiver_id)) |
-        ((Room.sender_id == receiver.receiver_id) & (Room.receiver_id == sender_id))
-    )
-    room__data = await session.execute(query_get)
-    try:
-        result = room__data.scalars().one()
-    except NoResultFound:
-        query = insert(Room).values(
-            key=unique_code,
-            sender_id=sender_id,
-            receiver_id=receiver.receiver_id
-        )
-        await session.execute(query)
-        await session.commit()
+    room = room_cache.get_pair(sender_id, receiver.receiver_id)
+    if room is None:
+        room = await upsert_room(session, sender_id, receiver.receiver_id)
+        room_cache.put(room)
+    return room
+
+
+def keyset(query, id_column, before_id: Optional[int], after_id: Optional[int],
+           since: Optional[datetime], until: Optional[datetime]):
+    """Restrict ``query`` to one keyset page: below ``before_id`` newest-first,
+    or above ``after_id`` oldest-first."""
+    if before_id is not None:
+        query = query.where(id_column < before_id)
+    if after_id is not None:
+        query = query.where(id_column > after_id)
+    if since is not None:
+        query = query.where(Message.created_at >= since)
+    if until is not None:
+        query = query.where(Message.created_at < until)
+    return query.order_by(id_column.desc() if after_id is None else id_column)
+
+
+def conversation_page(
+        sender_id: int,
+        receiver_id: int,
+        before_id: Optional[int],
+        limit: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        after_id: Optional[int] = None
+):
+    """Newest-first keyset page of one conversation.
 
-        result_query = select(Room).where(Room.key==unique_code)
-        result_data = await session.execute(result_query)
-        result = result_data.scalars().one()
-    print(result)
-    return result
+    Each direction is a separate range scan on (sender_id, receiver_id, id)
+    stopped after ``limit`` rows, so the cost does not depend on how long
+    the conversation is. ``since``/``until`` bound ``created_at``, which
+    lets the planner skip the monthly partitions outside of them. With
+    ``after_id`` the page runs oldest-first from just after that id.
+    """
+    def direction(from_id: int, to_id: int):
+        # explicit columns: inside a union the deferred search_vector would be read too
+        query = select(*SAVED_COLUMNS).where(Message.sender_id == from_id, Message.receiver_id == to_id)
+        query = keyset(query, Message.id, before_id, after_id, since, until)
+        return query.limit(limit)
 
+    if sender_id == receiver_id:
+        return direction(sender_id, receiver_id)
+    both = union_all(direction(sender_id, receiver_id), direction(receiver_id, sender_id)).subquery()
+    return select(both).order_by(both.c.id.desc() if after_id is None else both.c.id).limit(limit)
 
-@router.get('/messages', response_model=List[MessageShowScheme])
+
+def room_page(
+        room_id: int,
+        before_id: Optional[int],
+        limit: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        after_id: Optional[int] = None
+):
+    """Newest-first keyset page of a group room, one range scan on (room_id, id).
+
+    Oldest-first from just after ``after_id`` when it is given.
+    """
+    query = select(*SAVED_COLUMNS).where(Message.room_id == room_id)
+    return keyset(query, Message.id, before_id, after_id, since, until).limit(limit)
+
+
+def keyset_response(rows: List[dict], limit: int) -> dict:
+    """A page out of ``limit + 1`` rows; the extra one only says there is more."""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['id']
+    return {'items': rows, 'next_cursor': next_cursor}
+
+
+async def read_conversation(session: AsyncSession, page, before_id: Optional[int], limit: int) -> List[dict]:
+    """``page`` over the hot window first, older partitions only if it falls short.
+
+    ``page`` is ``conversation_page`` or ``room_page`` bound to the chat.
+    Active conversations fill their page from the newest partitions alone;
+    ids and created_at grow together, so the older half continues below
+    the last id of the newer one.
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=settings.MESSAGE_HOT_WINDOW_DAYS)
+    result = await session.execute(page(before_id, limit, since=since))
+    rows = [dict(row._mapping) for row in result]
+    if len(rows) < limit:
+        older_than = rows[-1]['id'] if rows else before_id
+        result = await session.execute(page(older_than, limit - len(rows), until=since))
+        rows.extend(dict(row._mapping) for row in result)
+    return rows
+
+
+@router.get('/messages', response_model=MessagePageScheme)
 async def get_chat_messages(
         receiver_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = Query(50, ge=1, le=200),
         token: dict = Depends(verify_token),
-        session: AsyncSession = Depends(get_async_session)
+        session: AsyncSession = Depends(get_async_session),
+        read_session: AsyncSession = Depends(get_read_session)
 ):
+    """Newest-first pages going back with ``?before_id=next_cursor``.
+
+    ``?after_id=`` pages forward instead, oldest-first: a client told to
+    sync asks for what came after the last message it has, following
+    ``next_cursor`` as ``after_id`` until it is null.
+    """
     if token is None:
         raise HTTPException(status_code=403, detail='Forbidden')
     sender_id = token.get('user_id')
-    query = select(Message).where(
-        (Message.sender_id == sender_id) & (Message.receiver_id == receiver_id) |
-        (Message.sender_id == receiver_id) & (Message.receiver_id == sender_id)
+    if after_id is not None:
+        if before_id is not None:
+            raise HTTPException(status_code=400, detail='Pass before_id or after_id, not both')
+        # the newest rows: from the primary, which the cache can't help with
+        page = conversation_page(sender_id, receiver_id, None, limit + 1, after_id=after_id)
+        return keyset_response([dict(row._mapping) for row in await session.execute(page)], limit)
+    key = conversation_key(sender_id, receiver_id)
+    fill = None
+    if before_id is None:
+        cached = history_cache.get(key, limit)
+        if cached is not None:
+            items, has_more = cached
+            return {'items': items, 'next_cursor': items[-1]['id'] if has_more and items else None}
+        fill = history_cache.begin_fill(key)
+    else:
+        # older pages can lag behind; the first page seeds the cache and
+        # has to come from the primary
+        session = read_session
+    rows = None
+    try:
+        rows = await read_conversation(session, partial(conversation_page, sender_id, receiver_id), before_id, limit + 1)
+    finally:
+        if fill is not None:
+            history_cache.end_fill(key, fill, rows, complete=rows is not None and len(rows) <= limit)
+    return keyset_response(rows, limit)
+
+
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=10, MaxFragments=2'
+# "&" first, so the entities added after it are not escaped again
+HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#x27;'))
+
+
+def html_escaped(text):
+    """SQL for ``text`` with the characters of ``html.escape`` replaced by entities."""
+    for character, entity in HTML_ESCAPES:
+        text = func.replace(text, character, entity)
+    return text
+
+
+def encode_cursor(*parts) -> str:
+    """An opaque cursor that survives a query string as is: URL-safe base64, no padding."""
+    return base64.urlsafe_b64encode('|'.join(map(str, parts)).encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> List[str]:
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def parse_search_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        rank, message_id = decode_cursor(cursor)
+        return float(rank), int(message_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def search_page(
+        user_id: int,
+        q: str,
+        receiver_id: Optional[int],
+        before: Optional[Tuple[float, int]],
+        limit: int,
+        room_id: Optional[int] = None
+):
+    """Best matches for ``q`` among the messages of ``user_id``'s rooms, groups included.
+
+    Candidates come from the GIN index on ``search_vector`` and are cut down
+    to the caller's rooms, so the cost follows the number of matches, not
+    the size of the conversations. The page is ordered by (rank, id) for
+    keyset paging; snippets are only built for the rows of the page.
+    """
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    rank = func.ts_rank(Message.search_vector, query)
+    if receiver_id is not None:
+        rooms = select(Room.id).where(Room.key == room_key(user_id, receiver_id))
+    elif room_id is not None:
+        rooms = member_rooms(user_id).where(RoomMember.room_id == room_id)
+    else:
+        rooms = union_all(
+            select(Room.id).where(or_(Room.sender_id == user_id, Room.receiver_id == user_id)),
+            member_rooms(user_id),
+        )
+    hits = select(Message.id, Message.created_at, rank.label('rank')).where(
+        Message.search_vector.op('@@')(query), Message.room_id.in_(rooms)
     )
-    message_data = await session.execute(query)
-    result = message_data.scalars().all()
-    return result
+    if before is not None:
+        hits = hits.where(tuple_(rank, Message.id) < before)
+    hits = hits.order_by(rank.desc(), Message.id.desc()).limit(limit).subquery()
+    return (
+        select(
+            Message.id,
+            Message.room_id,
+            Message.sender_id,
+            Message.receiver_id,
+            Message.attachment_id,
+            Message.created_at,
+            hits.c.rank,
+            # escaped first: the only markup in a snippet is the <mark> around matches
+            func.ts_headline(SEARCH_CONFIG, html_escaped(Message.message), query, HEADLINE_OPTIONS).label('snippet'),
+        )
+        # created_at lets each lookup go to a single monthly partition
+        .join(hits, and_(hits.c.id == Message.id, hits.c.created_at == Message.created_at))
+        .order_by(hits.c.rank.desc(), hits.c.id.desc())
+    )
+
+
+@router.get('/messages/search', response_model=MessageSearchPageScheme)
+async def search_messages(
+        q: str = Query(..., min_length=1, max_length=200),
+        receiver_id: Optional[int] = None,
+        room_id: Optional[int] = None,
+        before: Optional[str] = None,
+        limit: int = Query(20, ge=1, le=100),
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_read_session)
+):
+    """Search the caller's messages, optionally only the chat with ``receiver_id`` or group ``room_id``.
+
+    ``q`` takes web search syntax: words, "quoted phrases", ``or`` and
+    ``-excluded``. Pass ``next_cursor`` back as ``before`` for the next page.
+    """
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    user_id = token.get('user_id')
+    cursor = parse_search_cursor(before) if before is not None else None
+    result = await session.execute(search_page(user_id, q, receiver_id, cursor, limit + 1, room_id))
+    rows = [dict(row._mapping) for row in result]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(repr(rows[-1]['rank']), rows[-1]['id'])
+    return {'items': rows, 'next_cursor': next_cursor}
 
 
-@router.get('/rooms')
+def parse_inbox_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        activity, room_id = decode_cursor(cursor)
+        return datetime.fromisoformat(activity), int(room_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def inbox_page(user_id: int, before: Optional[Tuple[datetime, int]], limit: int):
+    """Rooms of ``user_id`` by last activity, newest first, with the peer and unread count.
+
+    In direct chats the user is either the room's sender or its receiver;
+    each side is its own range scan on (member, last_activity_at, id), so a
+    page reads about ``limit`` rows per side however many rooms the user
+    has. Groups come from the user's room_member rows, with their own
+    read count.
+    """
+    def side(peer, read_count, *criteria, join=None):
+        query = select(
+            Room.id,
+            Room.key,
+            Room.is_group,
+            Room.name,
+            peer.label('peer_id'),
+            Room.last_message_preview.label('last_message'),
+            Room.last_sender_id,
+            Room.last_activity_at,
+            (Room.message_count - read_count).label('unread_count'),
+        ).where(Room.last_activity_at.isnot(None), *criteria)
+        if join is not None:
+            query = query.join(*join)
+        if before is not None:
+            query = query.where(tuple_(Room.last_activity_at, Room.id) < before)
+        return query.order_by(Room.last_activity_at.desc(), Room.id.desc()).limit(limit)
+
+    rooms = union_all(
+        side(Room.receiver_id, Room.sender_read_count, Room.sender_id == user_id),
+        # a chat with oneself is already listed through the sender side
+        side(Room.sender_id, Room.receiver_read_count, Room.receiver_id == user_id, Room.sender_id != user_id),
+        side(
+            cast(null(), Integer), RoomMember.read_count, RoomMember.user_id == user_id,
+            join=(RoomMember, RoomMember.room_id == Room.id),
+        ),
+    ).subquery()
+    return (
+        select(rooms, UserData.first_name, UserData.last_name, UserData.username)
+        .outerjoin(UserData, UserData.id == rooms.c.peer_id)
+        .order_by(rooms.c.last_activity_at.desc(), rooms.c.id.desc())
+        .limit(limit)
+    )
+
+
+@router.get('/rooms', response_model=InboxPageScheme)
 async def get_my_chats(
+        before: Optional[str] = None,
+        limit: int = Query(30, ge=1, le=100),
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_read_session)
+):
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    user_id = token.get('user_id')
+    cursor = parse_inbox_cursor(before) if before is not None else None
+    result = await session.execute(inbox_page(user_id, cursor, limit + 1))
+    rows = [dict(row._mapping) for row in result]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['last_activity_at'].isoformat(), rows[-1]['id'])
+    return {'items': rows, 'next_cursor': next_cursor}
+
+
+@router.post('/rooms/{room_id}/read')
+async def mark_room_read(
+        room_id: int,
         token: dict = Depends(verify_token),
         session: AsyncSession = Depends(get_async_session)
 ):
     if token is None:
         raise HTTPException(status_code=403, detail='Forbidden')
     user_id = token.get('user_id')
-    query = select(Room).where((Room.sender_id == user_id) | (Room.receiver_id == user_id))
+    # both columns in one statement; only the caller's side changes
+    query = update(Room).where(
+        Room.id == room_id, (Room.sender_id == user_id) | (Room.receiver_id == user_id)
+    ).values(
+        sender_read_count=case((Room.sender_id == user_id, Room.message_count), else_=Room.sender_read_count),
+        receiver_read_count=case((Room.receiver_id == user_id, Room.message_count), else_=Room.receiver_read_count),
+    ).execution_options(synchronize_session=False)
+    result = await session.execute(query)
+    if result.rowcount == 0:
+        # group rooms keep every member's count in room_member
+        query = update(RoomMember).where(RoomMember.room_id == room_id, RoomMember.user_id == user_id).values(
+            read_count=select(Room.message_count).where(Room.id == room_id).scalar_subquery(),
+        ).execution_options(synchronize_session=False)
+        result = await session.execute(query)
+    await session.commit()
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail='Room not found')
+    return {'success': True}
+
+
+OWNER = 'owner'
+MEMBER = 'member'
+
+
+async def group_role(session: AsyncSession, room_id: int, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+    """Key of group ``room_id`` and the caller's role in it; Nones unless the caller is a member."""
+    query = select(Room.key, RoomMember.role).join(RoomMember, RoomMember.room_id == Room.id).where(
+        Room.id == room_id, Room.is_group == true(), RoomMember.user_id == user_id
+    )
+    row = (await session.execute(query)).first()
+    if row is None:
+        return None, None
+    return row.key, row.role
+
+
+async def add_members(session: AsyncSession, room_id: int, user_ids: Iterable[int], role: str = MEMBER) -> List[int]:
+    """Insert the members in one statement and return the ids actually added.
+
+    Unknown users and existing members are skipped. Newcomers start with
+    the room's history read, only what comes after them counts as unread.
+    """
+    rows = select(
+        Room.id.label('room_id'), UserData.id.label('user_id'), literal(role).label('role'), Room.message_count,
+    ).where(Room.id == room_id, UserData.id.in_(list(user_ids)))
+    query = (
+        pg_insert(RoomMember)
+        .from_select(['room_id', 'user_id', 'role', 'read_count'], rows)
+        .on_conflict_do_nothing(index_elements=[RoomMember.room_id, RoomMember.user_id])
+        .returning(RoomMember.user_id)
+    )
+    return list((await session.execute(query)).scalars())
+
+
+async def member_count(session: AsyncSession, room_id: int) -> int:
+    query = select(func.count()).select_from(RoomMember).where(RoomMember.room_id == room_id)
+    return (await session.execute(query)).scalar_one()
+
+
+@router.post('/groups', response_model=GroupScheme)
+async def create_group(
+        group: GroupCreateScheme,
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_async_session)
+):
+    """Create a group room owned by the caller; join it on a socket with its ``key``."""
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    user_id = token.get('user_id')
+    member_ids = set(group.member_ids) - {user_id}
+    if len(member_ids) + 1 > settings.GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f'Groups have at most {settings.GROUP_MAX_MEMBERS} members')
+    # last_activity_at lists the new group in its members' inboxes right away
+    query = insert(Room).values(
+        key=uuid.uuid4().hex, is_group=True, name=group.name, last_activity_at=func.now(),
+    ).returning(Room.id, Room.key, Room.name)
+    room = dict((await session.execute(query)).one()._mapping)
+    await add_members(session, room['id'], [user_id], OWNER)
+    added = await add_members(session, room['id'], member_ids) if member_ids else []
+    await session.commit()
+    return {**room, 'member_count': 1 + len(added)}
+
+
+@router.get('/groups/{room_id}/members', response_model=GroupMemberPageScheme)
+async def list_group_members(
+        room_id: int,
+        after_id: Optional[int] = None,
+        limit: int = Query(100, ge=1, le=1000),
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_read_session)
+):
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    key, _ = await group_role(session, room_id, token.get('user_id'))
+    if key is None:
+        raise HTTPException(status_code=404, detail='Group not found')
+    query = select(
+        RoomMember.user_id, RoomMember.role, RoomMember.joined_at,
+        UserData.first_name, UserData.last_name, UserData.username,
+    ).join(UserData, UserData.id == RoomMember.user_id).where(RoomMember.room_id == room_id)
+    if after_id is not None:
+        query = query.where(RoomMember.user_id > after_id)
+    result = await session.execute(query.order_by(RoomMember.user_id).limit(limit + 1))
+    items = [dict(row._mapping) for row in result]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1]['user_id']
+    return {'items': items, 'next_cursor': next_cursor}
+
+
+@router.post('/groups/{room_id}/members', response_model=GroupMembersScheme)
+async def add_group_members(
+        room_id: int,
+        members: GroupMembersScheme,
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_async_session)
+):
+    """Add users to a group (owners only); returns the ids that were not members yet."""
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    key, role = await group_role(session, room_id, token.get('user_id'))
+    if key is None:
+        raise HTTPException(status_code=404, detail='Group not found')
+    if role != OWNER:
+        raise HTTPException(status_code=403, detail='Only the owner can add members')
+    user_ids = set(members.user_ids)
+    # concurrent adds to the same group wait here, so each one counts the
+    # members the others committed
+    await session.execute(select(Room.id).where(Room.id == room_id).with_for_update())
+    if await member_count(session, room_id) + len(user_ids) > settings.GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f'Groups have at most {settings.GROUP_MAX_MEMBERS} members')
+    added = await add_members(session, room_id, user_ids) if user_ids else []
+    await session.commit()
+    if added:
+        await manager.update_members(key, added=added)
+    return {'user_ids': added}
+
+
+@router.delete('/groups/{room_id}/members/{member_id}')
+async def remove_group_member(
+        room_id: int,
+        member_id: int,
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_async_session)
+):
+    """Remove a member (owners), or leave the group (anyone but the owner)."""
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    user_id = token.get('user_id')
+    key, role = await group_role(session, room_id, user_id)
+    if key is None:
+        raise HTTPException(status_code=404, detail='Group not found')
+    if member_id == user_id and role == OWNER:
+        raise HTTPException(status_code=400, detail='The owner cannot leave the group')
+    if member_id != user_id and role != OWNER:
+        raise HTTPException(status_code=403, detail='Only the owner can remove members')
+    result = await session.execute(
+        delete(RoomMember).where(RoomMember.room_id == room_id, RoomMember.user_id == member_id)
+    )
+    if result.rowcount == 0:
+        await session.rollback()
+        raise HTTPException(status_code=404, detail='Member not found')
+    # their sockets leave the room on every worker before the row is gone,
+    # so no fan-out after the commit still reaches them
+    await manager.update_members(key, removed=[member_id])
+    try:
+        await session.commit()
+    except Exception:
+        await manager.update_members(key, added=[member_id])
+        raise
+    return {'success': True}
+
+
+@router.get('/groups/{room_id}/messages', response_model=MessagePageScheme)
+async def get_group_messages(
+        room_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = Query(50, ge=1, le=200),
+        token: dict = Depends(verify_token),
+        session: AsyncSession = Depends(get_async_session),
+        read_session: AsyncSession = Depends(get_read_session)
+):
+    """History of a group room; each message is stored once, whatever the member count.
+
+    Paged like ``/messages``, ``?after_id=`` included.
+    """
+    if token is None:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail='Pass before_id or after_id, not both')
+    if before_id is not None:
+        # like /messages, only the first page has to see the latest writes
+        session = read_session
+    key, _ = await group_role(session, room_id, token.get('user_id'))
+    if key is None:
+        raise HTTPException(status_code=404, detail='Group not found')
+    if after_id is not None:
+        page = room_page(room_id, None, limit + 1, after_id=after_id)
+        return keyset_response([dict(row._mapping) for row in await session.execute(page)], limit)
+    rows = await read_conversation(session, partial(room_page, room_id), before_id, limit + 1)
+    return keyset_response(rows, limit)
 
 
 app.include_router(register_router)
@@ -0,0 +1,264 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Everything here is updated from the event loop thread (SQLAlchemy's async
+# engine runs its events there too, and bcrypt timings are recorded after
+# the executor returns), so samples are plain attributes: no locks.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Labels = Tuple[str, ...]
+Collector = Callable[[], Iterable[Tuple[Labels, float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # per bucket, not cumulative; the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """One metric family; ``labels(...)`` returns a child to update.
+
+    Hold on to children on hot paths: the lookup is a dict get, the update
+    an attribute increment. A ``collect`` function instead reports
+    ``(label values, value)`` pairs when /metrics is scraped, for numbers
+    that already live elsewhere (connection counts, queue depths).
+    """
+
+    kind = ''
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            collect: Optional[Collector] = None,
+            registry: Optional['Registry'] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.children: Dict[Labels, object] = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _child(self):
+        return _Value()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}')
+            child = self.children[key] = self._child()
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        samples = self.collect() if self.collect is not None else (
+            (labels, child.value) for labels, child in tuple(self.children.items())
+        )
+        for labels, value in samples:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional['Registry'] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        bounds = self.buckets + (float('inf'),)
+        for labels, child in tuple(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{suffix} {_format_value(child.sum)}')
+            lines.append(f'{self.name}_count{suffix} {child.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_REQUESTS = Counter('chat_http_requests_total', 'HTTP requests by route and status.', ('method', 'route', 'status'))
+HTTP_LATENCY = Histogram('chat_http_request_duration_seconds', 'HTTP request latency by route.', ('method', 'route'))
+DB_QUERY_SECONDS = Histogram('chat_db_query_duration_seconds', 'Statement execution time.', ('engine', 'statement'))
+DB_TRANSACTION_SECONDS = Histogram(
+    'chat_db_transaction_duration_seconds', 'Time from BEGIN to COMMIT or ROLLBACK.', ('engine', 'outcome')
+)
+BCRYPT_SECONDS = Histogram('chat_bcrypt_duration_seconds', 'bcrypt hash and verify time.', ('operation',))
+JWT_DECODES = Counter('chat_jwt_decodes_total', 'JWT decodes by outcome.', ('result',))
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts it by route template and status.
+
+    Routes are labelled by their path template (``/files/{attachment_id}``)
+    so the label set stays bounded; requests no route matched share one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Optional[Dict[object, str]] = None
+
+    def _route(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {
+                getattr(route, 'endpoint', None) or getattr(route, 'app', None): route.path
+                for route in scope['app'].routes
+            }
+        return self._routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router fills in scope['endpoint'] on the way in
+            route = self._route(scope)
+            HTTP_LATENCY.labels(scope['method'], route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope['method'], route, status_code).inc()
+
+
+STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def statement_kind(statement: str) -> str:
+    words = statement[:32].split(None, 1)
+    word = words[0].upper() if words else ''
+    return word if word in STATEMENTS else 'OTHER'
+
+
+def instrument_engine(engine: AsyncEngine, name: str):
+    """Record statement and transaction times of ``engine`` under ``engine=name``."""
+    target = engine.sync_engine
+
+    @event.listens_for(target, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # on the execution context, so a failed statement leaves nothing behind
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(target, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        DB_QUERY_SECONDS.labels(name, statement_kind(statement)).observe(elapsed)
+
+    @event.listens_for(target, 'begin')
+    def begin(conn):
+        conn.info['metrics_transaction_started'] = time.perf_counter()
+
+    def ended(outcome: str):
+        def listener(conn):
+            started = conn.info.pop('metrics_transaction_started', None)
+            if started is not None:
+                DB_TRANSACTION_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+        return listener
+
+    event.listen(target, 'commit', ended('commit'))
+    event.listen(target, 'rollback', ended('rollback'))
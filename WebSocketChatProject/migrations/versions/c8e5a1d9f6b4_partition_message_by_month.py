@@ -0,0 +1,119 @@
+"""partition message by month
+
+Revision ID: c8e5a1d9f6b4
+Revises: b6d2f8e41c93
+Create Date: 2026-10-18 16:27:39.851402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'c8e5a1d9f6b4'
+down_revision: Union[str, None] = 'b6d2f8e41c93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# partitions created ahead of the current month; the maintenance task in
+# partitions.py keeps this many ahead from then on
+MONTHS_AHEAD = 3
+
+INDEXES = (
+    'ix_message_id',
+    'ix_message_sender_id_receiver_id_id',
+    'ix_message_room_id_id',
+    'ix_message_search_vector',
+)
+COLUMNS = 'id, sender_id, receiver_id, room_id, attachment_id, message, created_at'
+
+
+def create_message_table(**kwargs):
+    op.create_table('message',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('message_id_seq'::regclass)"), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('receiver_id', sa.Integer(), nullable=True),
+    sa.Column('room_id', sa.Integer(), nullable=True),
+    sa.Column('attachment_id', sa.Integer(), nullable=True),
+    sa.Column('message', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("to_tsvector('simple', coalesce(message, ''))", persisted=True), nullable=True),
+    sa.ForeignKeyConstraint(['attachment_id'], ['attachment.id'], name='message_attachment_id_fkey'),
+    sa.ForeignKeyConstraint(['receiver_id'], ['userdata.id'], ),
+    sa.ForeignKeyConstraint(['room_id'], ['room.id'], name='message_room_id_fkey'),
+    sa.ForeignKeyConstraint(['sender_id'], ['userdata.id'], ),
+    **kwargs
+    )
+
+
+def create_message_indexes():
+    op.create_index('ix_message_id', 'message', ['id'], unique=False)
+    op.create_index('ix_message_sender_id_receiver_id_id', 'message', ['sender_id', 'receiver_id', 'id'], unique=False)
+    op.create_index('ix_message_room_id_id', 'message', ['room_id', 'id'], unique=False)
+    op.create_index('ix_message_search_vector', 'message', ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def set_aside_message_table():
+    # index and primary key names are schema-wide, free them for the new table
+    for index in INDEXES:
+        op.drop_index(index, table_name='message')
+    op.rename_table('message', 'message_old')
+    op.execute('ALTER TABLE message_old RENAME CONSTRAINT message_pkey TO message_old_pkey')
+
+
+def drop_old_message_table():
+    op.execute("SELECT setval('message_id_seq', coalesce((SELECT max(id) FROM message), 0) + 1, false)")
+    # the sequence belongs to the old id column and would be dropped with it
+    op.execute('ALTER SEQUENCE message_id_seq OWNED BY message.id')
+    op.drop_table('message_old')
+
+
+def upgrade() -> None:
+    # Rewrites the whole table inside the migration's transaction: writes
+    # to message wait until it commits, plan a window for big tables.
+    # Partitioned tables need PostgreSQL 12+ (generated column, FKs).
+    set_aside_message_table()
+    # ### commands auto generated by Alembic - please adjust! ###
+    create_message_table(
+        sa.PrimaryKeyConstraint('id', 'created_at', name='message_pkey'),
+        postgresql_partition_by='RANGE (created_at)',
+    )
+    # ### end Alembic commands ###
+    # one partition per UTC month from the oldest message on, a few ahead,
+    # and a default one so that inserts never fail if maintenance stops
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month timestamp := date_trunc('month', coalesce(
+                (SELECT min(created_at) FROM message_old), now()
+            ) AT TIME ZONE 'UTC');
+        BEGIN
+            WHILE month <= date_trunc('month', now() AT TIME ZONE 'UTC') + interval '{MONTHS_AHEAD} months' LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF message FOR VALUES FROM (%L) TO (%L)',
+                    'message_p' || to_char(month, 'YYYYMM'),
+                    month AT TIME ZONE 'UTC',
+                    (month + interval '1 month') AT TIME ZONE 'UTC'
+                );
+                month := month + interval '1 month';
+            END LOOP;
+        END $$
+    """)
+    op.execute('CREATE TABLE message_default PARTITION OF message DEFAULT')
+    op.execute(f'INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_old')
+    drop_old_message_table()
+    # built once after the copy; creating them on the parent covers every
+    # partition, present and future
+    create_message_indexes()
+
+
+def downgrade() -> None:
+    # rows of partitions already detached by the maintenance task are not
+    # brought back, restore them from the archive if needed
+    set_aside_message_table()
+    create_message_table(sa.PrimaryKeyConstraint('id', name='message_pkey'))
+    op.execute(f'INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_old')
+    drop_old_message_table()
+    create_message_indexes()
@@ -1,6 +1,15 @@
-from sqlalchemy import Column, Integer, ForeignKey, String, MetaData
+from sqlalchemy import (
+    DDL, BigInteger, Boolean, Column, Computed, Integer, ForeignKey, String, MetaData, DateTime, Index, PrimaryKeyConstraint,
+    event, false, func,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from database import Base
 
+# text search configuration of Message.search_vector; queries must use the
+# same one. 'simple' doesn't stem, so it works the same for every language
+SEARCH_CONFIG = 'simple'
+
 metadata = MetaData()
 
 
@@ -14,20 +23,119 @@ class UserData(Base):
     username = Column(String)
     password = Column(String)
 
+    # case-insensitive prefix search for /users?q=
+    __table_args__ = (
+        Index(
+            'ix_userdata_username_prefix', func.lower(username).label('username_lower'),
+            postgresql_ops={'username_lower': 'text_pattern_ops'},
+        ),
+        Index(
+            'ix_userdata_first_name_prefix', func.lower(first_name).label('first_name_lower'),
+            postgresql_ops={'first_name_lower': 'text_pattern_ops'},
+        ),
+        Index(
+            'ix_userdata_last_name_prefix', func.lower(last_name).label('last_name_lower'),
+            postgresql_ops={'last_name_lower': 'text_pattern_ops'},
+        ),
+    )
+
 
 class Message(Base):
     __tablename__ = 'message'
     metadata = metadata
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    id = Column(Integer, index=True, autoincrement=True)
     sender_id = Column(Integer, ForeignKey("userdata.id"))
     receiver_id = Column(Integer, ForeignKey("userdata.id"))
+    room_id = Column(Integer, ForeignKey("room.id"), nullable=True)
+    # set on file-reference messages; the text is then the file name
+    attachment_id = Column(Integer, ForeignKey("attachment.id"), nullable=True)
     message = Column(String)
+    # partition key, see partitions.py; ids stay unique through the sequence
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # computed by Postgres on insert, so the GIN index grows row by row;
+    # deferred so that loading messages never drags it along
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed(f"to_tsvector('{SEARCH_CONFIG}', coalesce(message, ''))", persisted=True),
+    ))
+
+    # keyset pagination walks these newest-first by id
+    __table_args__ = (
+        # a partitioned table's primary key has to contain the partition key
+        PrimaryKeyConstraint('id', 'created_at', name='message_pkey'),
+        Index('ix_message_sender_id_receiver_id_id', 'sender_id', 'receiver_id', 'id'),
+        Index('ix_message_room_id_id', 'room_id', 'id'),
+        Index('ix_message_search_vector', 'search_vector', postgresql_using='gin'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
+
+# tables made by metadata.create_all (benchmarks, fresh databases) take rows
+# right away; monthly partitions are added by partitions.PartitionMaintainer
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL('CREATE TABLE IF NOT EXISTS message_default PARTITION OF message DEFAULT').execute_if(dialect='postgresql'),
+)
 
 
 class Room(Base):
     __tablename__ = 'room'
     metadata = metadata
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    key = Column(String)
+    # sha256 of the ordered user pair, see chat.cache.room_key; a random
+    # token for group rooms
+    key = Column(String, unique=True, index=True)
+    # the user pair of a direct chat; both are null for group rooms, whose
+    # members are in room_member
     sender_id = Column(ForeignKey('userdata.id'))
     receiver_id = Column(ForeignKey('userdata.id'))
+    is_group = Column(Boolean, nullable=False, server_default=false())
+    name = Column(String, nullable=True)
+
+    # inbox counters, kept current by chat.writer.save_messages; a member's
+    # unread count is message_count minus their read count
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_sender_id = Column(Integer, nullable=True)
+    last_activity_at = Column(DateTime(timezone=True), nullable=True)
+    message_count = Column(Integer, nullable=False, server_default='0')
+    sender_read_count = Column(Integer, nullable=False, server_default='0')
+    receiver_read_count = Column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        Index('ix_room_sender_id_last_activity_at', 'sender_id', 'last_activity_at', 'id'),
+        Index('ix_room_receiver_id_last_activity_at', 'receiver_id', 'last_activity_at', 'id'),
+    )
+
+
+class RoomMember(Base):
+    __tablename__ = 'room_member'
+    metadata = metadata
+    room_id = Column(Integer, ForeignKey('room.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('userdata.id'), primary_key=True)
+    # 'owner' or 'member'; owners add and remove members
+    role = Column(String, nullable=False, server_default='member')
+    # the member's side of the inbox counters: unread is room.message_count - read_count
+    read_count = Column(Integer, nullable=False, server_default='0')
+    joined_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    # the groups of a user, for the inbox and for search
+    __table_args__ = (
+        Index('ix_room_member_user_id_room_id', 'user_id', 'room_id'),
+    )
+
+
+class Attachment(Base):
+    __tablename__ = 'attachment'
+    metadata = metadata
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    uploader_id = Column(Integer, ForeignKey("userdata.id"))
+    room_id = Column(Integer, ForeignKey("room.id"), index=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    sha256 = Column(String, nullable=False)
+    # path relative to FILE_STORAGE_DIR, see chat.files.FileStore
+    storage_key = Column(String, nullable=False, unique=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -0,0 +1,306 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import anyio
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from models.models import Message
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'message'
+DEFAULT_PARTITION = 'message_default'
+PARTITION_NAME = re.compile(r'^message_p(\d{4})(\d{2})$')
+# pg_advisory_lock key held by whichever worker runs maintenance
+ADVISORY_LOCK_ID = 7_324_501_024
+# the generated search_vector is rebuilt from the text, it isn't archived
+COLUMNS = [column.name for column in Message.__table__.columns if column.computed is None]
+COLUMN_LIST = ', '.join(COLUMNS)
+
+ATTACHED = text("""
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = :table
+""")
+DETACHED = text("""
+    SELECT relname FROM pg_class
+    WHERE relkind = 'r' AND NOT relispartition AND relname ~ '^message_p[0-9]{6}$'
+""")
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f'message_p{month:%Y%m}'
+
+
+def partition_month(name: str) -> Optional[datetime]:
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+
+
+class NdjsonArchive:
+    """One JSON object per line, gzipped."""
+
+    extension = '.ndjson.gz'
+
+    def __init__(self, path: str):
+        self._file = gzip.open(path, 'wb', compresslevel=6)
+
+    def write(self, rows: List[dict]):
+        self._file.write(b''.join(orjson.dumps(row) + b'\n' for row in rows))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetArchive:
+    """A Parquet file written one row group per batch."""
+
+    extension = '.parquet'
+
+    def __init__(self, path: str):
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._path = path
+        self._writer = None
+
+    def write(self, rows: List[dict]):
+        table = self._pyarrow.Table.from_pylist(rows)
+        if self._writer is None:
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema, compression='zstd')
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+ARCHIVE_FORMATS = {'ndjson': NdjsonArchive, 'parquet': ParquetArchive}
+
+
+class PartitionMaintainer:
+    """Keeps the monthly partitions of ``message`` ahead of time and behind retention.
+
+    Every ``interval`` seconds one worker (whichever gets the advisory lock)
+    creates the partitions of the next ``months_ahead`` months, detaches the
+    ones older than ``retention_months`` and streams each detached partition
+    to ``archive_dir`` in batches before dropping it. Nothing happens on
+    databases other than PostgreSQL.
+
+    New partitions are created as plain tables and attached: rows that
+    landed in the default partition for that month are moved over first,
+    and ATTACH doesn't lock writers out of the parent the way CREATE TABLE
+    ... PARTITION OF does. All DDL runs under ``lock_timeout`` and a step
+    that can't get its lock is retried on the next run.
+    """
+
+    def __init__(
+            self,
+            engine: AsyncEngine,
+            months_ahead: int = 3,
+            retention_months: int = 0,
+            archive_dir: str = 'media/archive',
+            archive_format: str = 'ndjson',
+            batch_size: int = 5000,
+            interval: float = 3600,
+            lock_timeout: float = 5
+    ):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f'Unsupported archive format: {archive_format}')
+        if archive_format == 'parquet':
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise RuntimeError('Parquet archives require the "pyarrow" package')
+        self.engine = engine
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.archive = ARCHIVE_FORMATS[archive_format]
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock_timeout = lock_timeout
+        self.runs = 0
+        self.skipped_runs = 0
+        self.failures = 0
+        self.created = 0
+        self.detached = 0
+        self.archived = 0
+        self.archived_rows = 0
+        self.archived_bytes = 0
+        self.last_run_at: Optional[float] = None
+        self.last_run_seconds = 0.0
+        self.partitions: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.engine.dialect.name == 'postgresql'
+
+    async def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run()
+            except Exception:
+                self.failures += 1
+                logger.exception('Partition maintenance failed')
+            await asyncio.sleep(self.interval)
+
+    async def run(self, now: Optional[datetime] = None):
+        current = month_start(now or datetime.now(timezone.utc))
+        started = time.perf_counter()
+        async with self.engine.connect() as connection:
+            # session level, so it outlives the transactions below
+            locked = await connection.scalar(text('SELECT pg_try_advisory_lock(:key)'), {'key': ADVISORY_LOCK_ID})
+            await connection.commit()
+            if not locked:
+                self.skipped_runs += 1
+                return
+            try:
+                for offset in range(self.months_ahead + 1):
+                    await self.ensure_partition(connection, add_months(current, offset))
+                if self.retention_months > 0:
+                    cutoff = add_months(current, -self.retention_months)
+                    await self.detach_expired(connection, cutoff)
+                    # only what retention let go of: never a table detached by hand for other reasons
+                    for name in sorted(await self._names(connection, DETACHED)):
+                        if partition_month(name) < cutoff:
+                            await self.archive_partition(connection, name)
+                self.partitions = sorted(await self._names(connection, ATTACHED))
+            finally:
+                await connection.rollback()
+                await connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': ADVISORY_LOCK_ID})
+                await connection.commit()
+        self.runs += 1
+        self.last_run_at = time.time()
+        self.last_run_seconds = time.perf_counter() - started
+
+    async def _names(self, connection: AsyncConnection, query) -> List[str]:
+        result = await connection.execute(query, {'table': TABLE})
+        names = list(result.scalars())
+        await connection.commit()
+        return names
+
+    async def _ddl(self, connection: AsyncConnection, *statements) -> bool:
+        """Run ``statements`` in one transaction; False when it failed, e.g. a lock wasn't granted in time."""
+        try:
+            await connection.execute(text(f"SET LOCAL lock_timeout = '{int(self.lock_timeout * 1000)}ms'"))
+            for statement in statements:
+                await connection.execute(text(statement) if isinstance(statement, str) else statement)
+            await connection.commit()
+        except Exception:
+            await connection.rollback()
+            self.failures += 1
+            logger.exception('Partition DDL failed: %s', '; '.join(str(statement) for statement in statements))
+            return False
+        return True
+
+    async def ensure_partition(self, connection: AsyncConnection, month: datetime):
+        name = partition_name(month)
+        if name in await self._names(connection, ATTACHED):
+            return
+        end = add_months(month, 1)
+        statements = [f'CREATE TABLE IF NOT EXISTS {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING GENERATED)']
+        has_default = await connection.scalar(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': DEFAULT_PARTITION})
+        await connection.commit()
+        if has_default:
+            statements.append(text(
+                f'WITH moved AS ('
+                f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= :start AND created_at < :end '
+                f'RETURNING {COLUMN_LIST}'
+                f') INSERT INTO {name} ({COLUMN_LIST}) SELECT {COLUMN_LIST} FROM moved'
+            ).bindparams(start=month, end=end))
+        # indexes, the primary key and foreign keys of the parent are added on attach
+        statements.append(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        if await self._ddl(connection, *statements):
+            self.created += 1
+            logger.info('Created partition %s', name)
+
+    async def detach_expired(self, connection: AsyncConnection, cutoff: datetime):
+        """Detach partitions whose month starts before ``cutoff``; the default one is left alone."""
+        for name in sorted(await self._names(connection, ATTACHED)):
+            month = partition_month(name)
+            if month is None or month >= cutoff:
+                continue
+            if await self._ddl(connection, f'ALTER TABLE {TABLE} DETACH PARTITION {name}'):
+                self.detached += 1
+                logger.info('Detached partition %s', name)
+
+    async def archive_partition(self, connection: AsyncConnection, name: str):
+        """Stream a detached partition to a file in ``archive_dir``, then drop it."""
+        path = os.path.join(self.archive_dir, name + self.archive.extension)
+        # a file already in place means the last run stopped before the drop
+        if not await anyio.Path(path).exists():
+            await anyio.Path(self.archive_dir).mkdir(parents=True, exist_ok=True)
+            partial = f'{path}.part'
+            archive = await anyio.to_thread.run_sync(self.archive, partial)
+            rows = 0
+            try:
+                result = await connection.stream(text(f'SELECT {COLUMN_LIST} FROM {name} ORDER BY id'))
+                async for batch in result.mappings().partitions(self.batch_size):
+                    await anyio.to_thread.run_sync(archive.write, [dict(row) for row in batch])
+                    rows += len(batch)
+                await connection.commit()
+            except BaseException:
+                await connection.rollback()
+                await anyio.to_thread.run_sync(archive.close)
+                await anyio.Path(partial).unlink(missing_ok=True)
+                raise
+            await anyio.to_thread.run_sync(archive.close)
+            await anyio.Path(partial).rename(path)
+            self.archived_rows += rows
+            self.archived_bytes += (await anyio.Path(path).stat()).st_size
+            logger.info('Archived %d rows of %s to %s', rows, name, path)
+        if await self._ddl(connection, f'DROP TABLE {name}'):
+            self.archived += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'enabled': self.enabled,
+            'partitions': self.partitions,
+            'runs': self.runs,
+            'skipped_runs': self.skipped_runs,
+            'failures': self.failures,
+            'created': self.created,
+            'detached': self.detached,
+            'archived': self.archived,
+            'archived_rows': self.archived_rows,
+            'archived_bytes': self.archived_bytes,
+            'last_run_at': self.last_run_at,
+            'last_run_seconds': self.last_run_seconds,
+        }
@@ -0,0 +1,241 @@
+import heapq
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# close code for sockets that keep sending after being told to slow down;
+# 4000-4999 is reserved for applications, 4029 mirrors HTTP 429
+WS_CLOSE_RATE_LIMITED = 4029
+
+
+class Limit:
+    """A token bucket holding up to ``capacity`` tokens, refilled at ``rate`` per second."""
+
+    __slots__ = ('capacity', 'rate')
+
+    def __init__(self, capacity: float, rate: float):
+        if capacity <= 0 or rate <= 0:
+            raise ValueError('Limits must be positive')
+        self.capacity = capacity
+        self.rate = rate
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Limit':
+        """``"10/minute"``: bursts of 10, one more every 6 seconds."""
+        try:
+            count, period = spec.split('/')
+            return cls(float(count), float(count) / PERIODS[period.strip()])
+        except (KeyError, ValueError):
+            raise ValueError(f'Invalid rate limit: {spec!r}, expected "<count>/<second|minute|hour|day>"')
+
+
+def refill(limit: Limit, tokens: float, updated: float, now: float, cost: float) -> Tuple[float, float]:
+    """Bucket level after taking ``cost`` and the seconds to wait; nothing is taken when it's > 0."""
+    tokens = min(limit.capacity, tokens + max(0.0, now - updated) * limit.rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / limit.rate
+
+
+class MemoryStore:
+    """Buckets of this process only; least recently used keys are forgotten."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+
+    async def take(self, key: str, limit: Limit, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (limit.capacity, now))
+        tokens, wait = refill(limit, tokens, updated, now, cost)
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+    async def close(self):
+        pass
+
+
+# the same arithmetic as ``refill``, atomically on the server; the wait is
+# returned as a string because Redis truncates Lua numbers to integers
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisStore:
+    """Buckets shared by every worker, one hash per key.
+
+    A take is one script call, so there is no read-modify-write race
+    between workers. Buckets expire once they would be full again. When
+    Redis is unreachable requests are let through: a limiter outage must
+    not take the API down with it.
+    """
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = 'chat:ratelimit:'):
+        if client is None:
+            try:
+                from redis import asyncio as aioredis
+            except ImportError:
+                raise RuntimeError('RedisStore requires the "redis" package')
+            client = aioredis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.errors = 0
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key: str, limit: Limit, cost: float = 1) -> float:
+        try:
+            wait = await self._take(keys=[self.prefix + key], args=[limit.capacity, limit.rate, time.time(), cost])
+        except Exception:
+            self.errors += 1
+            logger.exception('Rate limit store failed, letting the request through')
+            return 0.0
+        return float(wait)
+
+    async def close(self):
+        await self.client.close()
+
+
+def make_store(url: Optional[str]):
+    if not url or url.startswith('memory://'):
+        return MemoryStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError(f'Unsupported rate limit store url: {url}')
+
+
+class RateLimiter:
+    """Named limits checked against a bucket store, with throttling counters.
+
+    Keys are whatever identifies the caller for a rule (``user:1``,
+    ``ip:10.0.0.1``); each rule has its own buckets. The most throttled
+    keys are tracked, bounded, so /ws/stats can show who is being held
+    back.
+    """
+
+    def __init__(self, store=None, limits: Optional[Dict[str, Limit]] = None, max_tracked: int = 10000):
+        self.store = store if store is not None else MemoryStore()
+        self.limits: Dict[str, Limit] = dict(limits or {})
+        self.max_tracked = max_tracked
+        self.allowed: Dict[str, int] = {}
+        self.throttled: Dict[str, int] = {}
+        self.throttled_keys: 'OrderedDict[Tuple[str, str], int]' = OrderedDict()
+
+    async def hit(self, rule: str, key: str, cost: float = 1) -> float:
+        """Seconds to wait before retrying, 0 when the call may go ahead."""
+        wait = await self.store.take(f'{rule}:{key}', self.limits[rule], cost)
+        if wait > 0:
+            self.record(rule, key)
+        else:
+            self.allowed[rule] = self.allowed.get(rule, 0) + 1
+        return wait
+
+    def record(self, rule: str, key: str):
+        self.throttled[rule] = self.throttled.get(rule, 0) + 1
+        tracked = self.throttled_keys
+        point = (rule, key)
+        tracked[point] = tracked.get(point, 0) + 1
+        tracked.move_to_end(point)
+        if len(tracked) > self.max_tracked:
+            tracked.popitem(last=False)
+
+    async def close(self):
+        await self.store.close()
+
+    def stats(self, top: int = 10) -> dict:
+        most = heapq.nlargest(top, self.throttled_keys.items(), key=lambda item: item[1])
+        return {
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+            'top_throttled': [{'rule': rule, 'key': key, 'count': count} for (rule, key), count in most],
+        }
+
+
+def client_ip(scope) -> str:
+    # run uvicorn with --proxy-headers behind a proxy so this is the real client
+    client = scope.get('client')
+    return f'ip:{client[0]}' if client else 'ip:unknown'
+
+
+Rule = Tuple[str, Callable[[dict], str]]
+
+
+class RateLimitMiddleware:
+    """Answers 429 with Retry-After before a limited route does any work.
+
+    ``rules`` maps ``(method, path)`` to a limiter rule name and a function
+    that derives the caller's key from the ASGI scope; ``websocket_rule``
+    applies to every WebSocket handshake. Everything else passes through
+    untouched.
+    """
+
+    def __init__(
+            self,
+            app,
+            limiter: RateLimiter,
+            rules: Dict[Tuple[str, str], Rule],
+            websocket_rule: Optional[Rule] = None
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.rules = rules
+        self.websocket_rule = websocket_rule
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            rule = self.rules.get((scope['method'], scope['path']))
+            if rule is not None:
+                name, identify = rule
+                wait = await self.limiter.hit(name, identify(scope))
+                if wait > 0:
+                    await self._reject(send, wait)
+                    return
+        elif scope['type'] == 'websocket' and self.websocket_rule is not None:
+            name, identify = self.websocket_rule
+            if await self.limiter.hit(name, identify(scope)) > 0:
+                # a close before the accept turns the handshake down (HTTP 403)
+                await receive()
+                await send({'type': 'websocket.close', 'code': WS_CLOSE_RATE_LIMITED})
+                return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def _reject(send, wait: float):
+        body = orjson.dumps({'detail': 'Too many requests', 'retry_after': round(wait, 3)})
+        await send({
+            'type': 'http.response.start',
+            'status': 429,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'retry-after', str(math.ceil(wait)).encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import List, Optional
+
 from pydantic import BaseModel
 
 
@@ -21,4 +24,82 @@ class MessageShowScheme(BaseModel):
     id: int
     message: str
     sender_id: int
-    receiver_id: int
+    # None for messages of group rooms
+    receiver_id: Optional[int] = None
+    room_id: Optional[int] = None
+    attachment_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class MessagePageScheme(BaseModel):
+    items: List[MessageShowScheme]
+    next_cursor: Optional[int] = None
+
+
+class MessageSearchHitScheme(BaseModel):
+    id: int
+    room_id: Optional[int] = None
+    sender_id: int
+    receiver_id: Optional[int] = None
+    attachment_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    rank: float
+    # HTML: the message text around the matches, escaped, with matched
+    # words in <mark></mark>; safe to render as markup
+    snippet: str
+
+
+class MessageSearchPageScheme(BaseModel):
+    items: List[MessageSearchHitScheme]
+    next_cursor: Optional[str] = None
+
+
+class InboxRoomScheme(BaseModel):
+    id: int
+    key: str
+    is_group: bool = False
+    # group rooms have a name instead of a peer
+    name: Optional[str] = None
+    peer_id: Optional[int] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    username: Optional[str] = None
+    last_message: Optional[str] = None
+    last_sender_id: Optional[int] = None
+    last_activity_at: datetime
+    unread_count: int
+
+
+class InboxPageScheme(BaseModel):
+    items: List[InboxRoomScheme]
+    next_cursor: Optional[str] = None
+
+
+class GroupCreateScheme(BaseModel):
+    name: str
+    member_ids: List[int] = []
+
+
+class GroupScheme(BaseModel):
+    id: int
+    key: str
+    name: Optional[str] = None
+    member_count: int
+
+
+class GroupMembersScheme(BaseModel):
+    user_ids: List[int]
+
+
+class GroupMemberScheme(BaseModel):
+    user_id: int
+    role: str
+    joined_at: datetime
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    username: Optional[str] = None
+
+
+class GroupMemberPageScheme(BaseModel):
+    items: List[GroupMemberScheme]
+    next_cursor: Optional[int] = None